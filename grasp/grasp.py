@@ -1,7 +1,22 @@
+import array
+import csv
+import inspect
+import json
+import mmap
+import multiprocessing
+import numbers
+import os
+import pickle
+import random
 import re
 import sys
+import time
 import types
-from functools import reduce
+import weakref
+from collections import deque
+from functools import partial, reduce
+from itertools import count, islice, repeat
+from multiprocessing import shared_memory
 
 # Handle numpy types if numpy is available.
 try:
@@ -18,12 +33,11 @@ try:
 except (ImportError, SyntaxError):
     pass
 
-# This is just to test for a poorly written __cmp__ function in
-# distutils.version.LooseVersion.  Importing distutils should always work but I don't want to give the impression that we need it if something goes wrong.
+# The regexp parser, to find the plain text that a regexp needs.
 try:
-    import distutils
+    import re._parser as sre_parse
 except ImportError:
-    distutils = False
+    import sre_parse
 
 verbose = False
 
@@ -45,13 +59,28 @@ verbose = False
 # Types in list_types must respond to __iter__().  Designed for things
 # you access via [int]
 #
-# Types in instance_types must give sensible results to dir(),
-# getattr().  Designed for things you access via .
+# Types in instance_types keep their attributes in __dict__ or
+# __slots__.  Designed for things you access via .  Instances of
+# other classes are searched this way with apropos(..., instances=True)
+#
+# Subclasses of these types are searched the same way.  For complete
+# control, use register_introspector() to give the function that lists
+# the contents of a type.
 
 apropos_dict_types = [dict]
 apropos_list_types = [list, tuple]
 apropos_instance_types = [types.ModuleType]
 
+# Map types to (function, access) pairs.  See register_introspector().
+apropos_introspectors = {}
+
+# The value searches look at no more than this many characters of the
+# string of an object.  Objects of the types in value_skipped_types
+# with more elements than that aren't turned into strings at all,
+# since their strings list every element.  See render_value().
+apropos_value_limit = 100000
+apropos_value_skipped_types = [set, frozenset, deque, array.array]
+
 ##################################################
 # Information about types for recursive_types() function.
 ##################################################
@@ -84,6 +113,10 @@ recursive_type_composite_types = [list, tuple, dict, set, frozenset]
 if numpy:
     recursive_type_composite_types += [numpy.ndarray]
 
+# Types described through the buffer protocol, by the format, shape and
+# flags of a memoryview, which doesn't copy or read their data.
+recursive_type_buffer_types = [bytes, bytearray, memoryview, array.array, mmap.mmap]
+
 ##############################
 ## Utilities.
 class sstr(object):
@@ -118,11 +151,19 @@ def isstring(obj):
 ##################################################
 ## Introspection
 ##################################################
-def gist(obj, verbose=False, pretty=True):
+def gist(obj, verbose=False, pretty=True, static=None):
     """See what an object is all about.  Make a dict where the keys
     are the names of each type of attribute in the object.  The values
     are a list of the names of the attribute of that type.
 
+    If static is true, look attributes up with inspect.getattr_static()
+    rather than getattr(), and list them with static_dir() rather than
+    dir(), so no properties, __getattr__ or __dir__ functions are run.
+    Descriptors are listed by kind (property, getset_descriptor, ...),
+    and attributes that only __getattr__ could provide, such as lazily
+    loaded submodules, under DynamicAttribute.  By default, modules
+    are looked at statically and everything else with getattr().
+
     >>> gist((1,2,3))
     {builtin_function_or_method: [count, index]}
 
@@ -139,34 +180,370 @@ def gist(obj, verbose=False, pretty=True):
     else:
         string = str
 
-    info = []
-    for name in dir(obj):
-        if verbose or not name.startswith("_"):
-            try:
-                attr = getattr(obj, name)
-            # TODO -- bare except clause here.  What exceptions am I
-            # afraid of?
-            except:
-                attr = Exception
-            info.append((name, type(attr)))
+    if static is None:
+        static = isinstance(obj, types.ModuleType)
+
+    if gist_cacheable(obj):
+        groups = cached_gist_groups(obj, verbose, static)
+    else:
+        groups = {}
+        for name, attr_type in gist_info(obj, verbose, static):
+            groups.setdefault(attr_type, []).append(name)
 
-    types = sorted(set([el[1] for el in info]), key=str)
     # TODO result used to be a list, not a dict.  Do I prefer that
     # since I'll have deterministic ordering in printouts?  Might make
     # programmatic processing of output worse, but I don't do that
     # anyway and I can always just pass the list to a dict.
     result = {}
-    for tt in types:
-        names = [string(name) for name, the_type in info if the_type is tt]
-        result[string(tt.__name__)] = names
-        # result.append((t.__name__, names))
+    for tt in sorted(groups, key=str):
+        result[string(tt.__name__)] = [string(name) for name in groups[tt]]
+    return result
+
+
+def gist_info(obj, verbose=False, static=False):
+    """Yield (name, type) for each attribute of obj that gist() shows,
+    in alphabetical order, without any caching.
+
+    """
+    if static:
+        for name in static_dir(obj):
+            if verbose or not name.startswith("_"):
+                try:
+                    attr = inspect.getattr_static(obj, name)
+                except AttributeError:
+                    attr = DynamicAttribute()
+                yield name, type(attr)
+    else:
+        for name in dir(obj):
+            if verbose or not name.startswith("_"):
+                try:
+                    attr = getattr(obj, name)
+                # TODO -- bare except clause here.  What exceptions am I
+                # afraid of?
+                except:
+                    attr = Exception
+                yield name, type(attr)
+
+
+# The class level part of gist() for each type, so that looking at
+# many instances of the same class only merges in each instance's own
+# __dict__.  Maps a class to {(verbose, static): GistTypeInfo}.
+gist_type_cache = weakref.WeakKeyDictionary()
+
+# Non-data descriptors that give an attribute of the same type whatever
+# instance they are looked up on, so that their type can be cached.
+# Any other descriptor (cached_property, say) is looked up on every
+# instance.
+gist_stable_descriptors = (types.FunctionType, types.BuiltinFunctionType,
+                           types.MethodDescriptorType,
+                           types.ClassMethodDescriptorType,
+                           types.WrapperDescriptorType,
+                           classmethod, staticmethod)
+
+
+def gist_cacheable(obj):
+    """True if gist() can compute the attributes of obj from those of its
+    class plus its own __dict__: it isn't None, a class or a module, and
+    its class leaves dir() and attribute lookup alone.
+
+    """
+    cls = type(obj)
+    # Descriptors take None to mean they were looked up on the class.
+    if obj is None or isinstance(obj, (type, types.ModuleType)):
+        return False
+    try:
+        return (cls.__dir__ is object.__dir__
+                and cls.__getattribute__ is object.__getattribute__
+                and not hasattr(cls, "__getattr__"))
+    except AttributeError:
+        return False
+
+
+def is_data_descriptor(attr):
+    """True if attr is a descriptor that takes precedence over the
+    instance __dict__.
+
+    """
+    return hasattr(type(attr), "__set__") or hasattr(type(attr), "__delete__")
+
+
+class GistTypeInfo(object):
+    """The part of gist() that only depends on the class of an object.
+
+    groups maps attribute types to sorted lists of names, and kinds
+    maps each of those names back to its type.  lookup lists the names
+    whose type has to be found on each instance (properties and other
+    descriptors), and data the names that an instance __dict__ can't
+    override.  The number of attributes of the class and of each of
+    its bases is kept to notice when one is added or deleted, and the
+    classes themselves only through weak references, since this is
+    cached against the class.  Replacing a class attribute with one of
+    another type isn't noticed: gist_type_cache.clear() starts afresh.
+
+    """
+    def __init__(self, obj, verbose, static):
+        cls = type(obj)
+        self.mro = tuple(weakref.ref(klass) for klass in cls.__mro__)
+        self.sizes = [len(vars(klass)) for klass in cls.__mro__]
+        self.groups = {}
+        self.kinds = {}
+        self.lookup = []
+        self.data = set()
+        class_dict = {}
+        for klass in reversed(cls.__mro__):
+            class_dict.update(vars(klass))
+        names = [name for name in class_dict if type(name) is str]
+        for name in sorted(names):
+            if not (verbose or not name.startswith("_")):
+                continue
+            attr = class_dict[name]
+            if is_data_descriptor(attr):
+                self.data.add(name)
+            if not static and hasattr(type(attr), "__get__"):
+                if (name in self.data
+                    or not isinstance(attr, gist_stable_descriptors)):
+                    self.lookup.append(name)
+                    continue
+                # Not getattr(), which could find the __dict__ of obj.
+                try:
+                    attr = attr.__get__(obj, cls)
+                except:
+                    attr = Exception
+            self.groups.setdefault(type(attr), []).append(name)
+            self.kinds[name] = type(attr)
+
+    def current(self, cls):
+        """True if cls still has the attributes it had when this was made."""
+        mro = cls.__mro__
+        if len(mro) != len(self.mro):
+            return False
+        for klass, ref, size in zip(mro, self.mro, self.sizes):
+            if ref() is not klass or len(vars(klass)) != size:
+                return False
+        return True
+
+
+def cached_gist_groups(obj, verbose=False, static=False):
+    """Group the attributes of obj by type the way gist() does, reusing
+    what was worked out for its class before.
+
+    """
+    cls = type(obj)
+    key = (verbose, static)
+    infos = gist_type_cache.setdefault(cls, {})
+    info = infos.get(key)
+    if info is None or not info.current(cls):
+        info = infos[key] = GistTypeInfo(obj, verbose, static)
+
+    try:
+        contents = object.__getattribute__(obj, "__dict__")
+    except AttributeError:
+        contents = {}
+    # The lists in info.groups are shared, so copy any that change.
+    groups = dict(info.groups)
+    changed = set()
+
+    def names_of(attr_type):
+        if attr_type not in changed:
+            groups[attr_type] = list(groups.get(attr_type, ()))
+            changed.add(attr_type)
+        return groups[attr_type]
+
+    shadowed = set()
+    for name, attr in list(contents.items()):
+        if (type(name) is not str or name in info.data
+            or not (verbose or not name.startswith("_"))):
+            continue
+        if name in info.kinds:
+            names_of(info.kinds[name]).remove(name)
+        shadowed.add(name)
+        names_of(type(attr)).append(name)
+    for name in info.lookup:
+        if name not in shadowed:
+            try:
+                attr = getattr(obj, name)
+            except:
+                attr = Exception
+            names_of(type(attr)).append(name)
+
+    for attr_type in changed:
+        if groups[attr_type]:
+            groups[attr_type].sort()
+        else:
+            del groups[attr_type]
+    return groups
+
+
+def gist_many(objs, verbose=False, pretty=True, static=None):
+    """Get the gist of a collection of objects, one type at a time.
+
+    Group the objects by type and make a dict where the keys are the
+    names of the types, qualified by their module if different types
+    have the same name.  Each value says how many objects there are of
+    that type, gives the gist() of the first one, and lists the
+    attributes where the instance __dict__ and __slots__ of the objects
+    differ: the number of objects where the attribute has each type,
+    and where it is missing.  Attributes of the class, properties
+    included, are only looked at on the first object of each type.
+
+    >>> gist_many([Fraction(1, 2), 1, 2, Point(1, 2), Point(1.0, None)])
+    {Point: {count: 2, gist: {int: [x, y]},
+             differs: {x: {float: 1, int: 1}, y: {NoneType: 1, int: 1}}},
+     Fraction: {count: 1, gist: {...}, differs: {}},
+     int: {count: 2, gist: {...}, differs: {}}}
+
+    """
+    if pretty:
+        string = sstr
+    else:
+        string = str
+
+    first = {}
+    counts = {}
+    seen = {}
+    slots = {}
+    for obj in objs:
+        cls = type(obj)
+        if cls not in first:
+            first[cls] = obj
+            counts[cls] = 0
+            seen[cls] = {}
+            slots[cls] = slot_descriptors(cls)
+        counts[cls] += 1
+        try:
+            contents = list(object.__getattribute__(obj, "__dict__").items())
+        except AttributeError:
+            contents = []
+        for name, descriptor in slots[cls]:
+            try:
+                contents.append((name, descriptor.__get__(obj, cls)))
+            except AttributeError:
+                # Empty slot
+                pass
+        attrs = seen[cls]
+        for name, attr in contents:
+            if type(name) is str and (verbose or not name.startswith("_")):
+                kinds = attrs.setdefault(name, {})
+                kinds[type(attr)] = kinds.get(type(attr), 0) + 1
+
+    names = gist_many_names(first)
+    result = {}
+    for cls in sorted(first, key=names.get):
+        differs = {}
+        for name in sorted(seen[cls]):
+            kinds = seen[cls][name]
+            present = sum(kinds.values())
+            if len(kinds) > 1 or present < counts[cls]:
+                differs[string(name)] = dict(
+                    (string(kind.__name__), kinds[kind])
+                    for kind in sorted(kinds, key=str))
+                if present < counts[cls]:
+                    differs[string(name)][string("missing")] = \
+                        counts[cls] - present
+        result[string(names[cls])] = {
+            string("count"): counts[cls],
+            string("gist"): gist(first[cls], verbose, pretty, static),
+            string("differs"): differs}
+    return result
+
+
+def gist_many_names(classes):
+    """Map each of classes to the name gist_many() gives it: its
+    __name__, or if another class has the same one, its module and
+    __qualname__, followed by a number if that isn't enough either.
+
+    """
+    names = {}
+    for cls in classes:
+        names.setdefault(cls.__name__, []).append(cls)
+    result = {}
+    for name, same in names.items():
+        if len(same) == 1:
+            result[same[0]] = name
+            continue
+        qualified = {}
+        for cls in same:
+            qualified.setdefault("%s.%s" % (cls.__module__, cls.__qualname__),
+                                 []).append(cls)
+        for qualname, clashes in qualified.items():
+            for i, cls in enumerate(clashes):
+                result[cls] = qualname if len(clashes) == 1 else "%s (%d)" % (
+                    qualname, i + 1)
     return result
 
 
-def recursive_type(obj, max=50):
+class DynamicAttribute(object):
+    """Stands for an attribute that can't be found without running code,
+    such as one provided by a module's __getattr__.
+
+    """
+
+
+def static_dir(obj):
+    """Like dir(), but without running any __dir__ function: the names
+    in the __dict__ of obj and of its type and base classes, and those
+    listed in __all__, which is where lazily loaded attributes of
+    modules usually show up.
+
+    """
+    names = set()
+    try:
+        contents = object.__getattribute__(obj, "__dict__")
+    except AttributeError:
+        contents = {}
+    names.update(contents)
+    if isinstance(contents.get("__all__"), (list, tuple)):
+        names.update(contents["__all__"])
+    classes = list(type(obj).__mro__)
+    if isinstance(obj, type):
+        classes += obj.__mro__
+    for klass in classes:
+        names.update(vars(klass))
+    return sorted(name for name in names if type(name) is str)
+
+
+def recursive_type(obj, max=50, max_depth=None, sample=None, seed=None,
+                   schema=False, processes=None, signature=False):
     """Recursive type() function.  Try to give a concise description of
     the type of an object and all objects it contains.
 
+    Each container is described once, however many times it appears,
+    and a container that contains itself is described as a
+    back-reference to the enclosing container at that depth (the
+    outermost object is at depth 0).  Lists of more than max objects
+    with differing types are cut short.  Containers at max_depth or
+    deeper are described without looking inside them, ending in "…".
+    There is no limit on depth otherwise: this doesn't recurse.
+
+    If sample is given, containers with more elements than that are
+    described from a sample of sample elements: the first, the last and
+    a random selection of the others, chosen with random.Random(seed).
+    Their descriptions say so, and give their size only roughly.  This
+    is much faster for huge containers, but can miss the odd element of
+    a different type.
+
+    If schema is true, lists and tuples of dicts, such as JSON records,
+    are described by merging the dicts into one schema: each key, the
+    types of its values, and how many of the dicts have it if not all
+    of them.  Keys whose values are dicts get a schema of their own.
+
+    If processes is given, a container with at least
+    recursive_type_parallel_threshold elements is split into chunks
+    described by that many worker processes (0 for one per CPU), and
+    their summaries merged into the same result.  This doesn't apply
+    when sampling.  On Linux, workers are forked and read the container
+    from the memory they share with this one.  Elsewhere, elements that
+    are buffers are copied to them through shared memory and the others
+    pickled; if some can't be, the container is described without
+    workers.  Elements that refer back to the container itself are only
+    recognized in the first case.
+
+    The description is a str, or a list of the description of the
+    container followed by those of its contents.  If signature is true,
+    an RType is returned instead of a list: equal RTypes are the same
+    object, so they can be compared and hashed cheaply, to group
+    objects by their recursive type for instance.
+
     >>> recursive_type(1)
     'int'
 
@@ -182,61 +559,1292 @@ def recursive_type(obj, max=50):
     >>> recursive_type((numpy.array([1,2]), numpy.array([3,4]), numpy.array([5,6])))
     ['tuple of 3', 'ndarray of (2,) int64']
 
+    >>> a = [1]; a.append(a); recursive_type(a)
+    ['list of', 'int', 'back-reference to list at depth 0']
+
+    >>> recursive_type([[[1, 2]], [[3, 4]]], max_depth=1)
+    ['list of 2', 'list of 1 …']
+
+    >>> recursive_type(list(range(10**8)), sample=1000)
+    'list of ~1e8 int (sampled 1000)'
+
+    >>> recursive_type([dict(id=1, tags=['a']), dict(id=2, email=None)],
+    ...                schema=True)
+    ['list of 2 records', 'id: int', 'tags: list of 1 str (optional, 1 of 2)',
+     'email: NoneType (optional, 1 of 2)']
+
     """
+    engine = RecursiveType(
+        max=max, max_depth=max_depth, sample=sample, seed=seed, schema=schema
+    )
+    if processes is not None and sample is None:
+        result = engine.describe_parallel(obj, processes)
+        if result is not None:
+            return result if signature else rtype_render(result)
+    result = engine.describe(obj)
+    return result if signature else rtype_render(result)
+
+
+# Containers with fewer elements than this are never described in
+# parallel, since starting worker processes takes longer.
+recursive_type_parallel_threshold = 100000
+
+# Whether describe_parallel() forks its workers, so that they share the
+# container instead of getting a copy.  Only Linux can fork processes
+# safely: on macOS, system libraries may crash in forked children.
+recursive_type_parallel_fork = sys.platform.startswith("linux")
+
+# Number of different record schemas that schema mode keeps, so that
+# records with the same keys and types share theirs.
+recursive_type_shapes = 10000
+
+
+def recursive_type_file(path, format=None, limit=None, sample=None, seed=None,
+                        max=50, max_depth=None, schema=False,
+                        encoding="utf-8", report=None, signature=False):
+    """The recursive_type() of the list of records in a JSON Lines or
+    CSV file, without reading the list into memory.  The file is
+    memory mapped and each record described as it's read and then
+    dropped.  CSV records are dicts, as csv.DictReader gives them.  A
+    JSON file holds a single document, which has to be read whole with
+    json.load(), and is then described like any other object.
+
+    format is 'jsonl', 'json', 'csv' or 'tsv', taken from the file name
+    extension by default.  limit looks at the first limit records only.
+    sample is as for recursive_type(): the records are counted first,
+    and only those sampled are parsed.  The other arguments are also
+    those of recursive_type().  report, if given, is called with a line
+    giving the number of records and bytes read and the throughput.
+
+    >>> recursive_type_file('events.jsonl', schema=True, report=print)
+    120000 records, 48.2 MB in 3.10s (15.5 MB/s)
+    ['list of 120000 records', 'id: int', 'kind: str', ...]
 
-    def rtypes_equal(els):
-        """Return True if all rtypes equal"""
-        first_type = recursive_type(els[0])
-        return every([recursive_type(el) == first_type for el in els])
+    """
+    if format is None:
+        format = rtype_file_formats.get(path.rsplit(".", 1)[-1].lower())
+    if format not in ("jsonl", "json", "csv", "tsv"):
+        raise ValueError("format must be 'jsonl', 'json', 'csv' or 'tsv', not %r"
+                         % (format,))
+    engine = RecursiveType(max=max, max_depth=max_depth, sample=sample,
+                           seed=seed, schema=schema)
+    started = time.time()
+    if format == "json":
+        result, count, size = rtype_json_file(engine, path, limit, encoding)
+    else:
+        result, count, size = rtype_stream_file(engine, path, format, limit,
+                                                sample, encoding)
+    if report:
+        elapsed = time.time() - started
+        rate = size / 1e6 / elapsed if elapsed else float("inf")
+        report("%d records, %.1f MB in %.2fs (%.1f MB/s)" % (
+            count, size / 1e6, elapsed, rate))
+    return result if signature else rtype_render(result)
 
-    def types_equal(els):
-        """Return True if all types equal"""
-        first_type = type(els[0])
-        return every([type(el) is first_type for el in els])
 
-    def types_simple(els):
-        """Return True if all types simple"""
-        return every([type(el) in recursive_type_simple_types for el in els])
+def rtype_json_file(engine, path, limit=None, encoding="utf-8"):
+    """Describe the document in a JSON file with engine, a RecursiveType,
+    as recursive_type_file() does.  Return the description, the number
+    of records, if the document is a list, and the size of the file.
 
-    def name(obj):
-        """Return the name of obj"""
-        return type(obj).__name__
+    """
+    with open(path, encoding=encoding) as f:
+        obj = json.load(f)
+        size = os.fstat(f.fileno()).st_size
+    if type(obj) is not list:
+        return engine.describe(obj), 1, size
+    if limit is not None:
+        obj = obj[:limit]
+    return engine.describe(obj), len(obj), size
+
+
+def rtype_stream_file(engine, path, format, limit=None, sample=None,
+                      encoding="utf-8"):
+    """Describe the records in a JSON Lines or CSV file with engine, a
+    RecursiveType, as recursive_type_file() does.  Return the
+    description, the number of records described and bytes read.
 
-    def shape(obj):
-        """Return the shape of obj"""
-        if numpy and type(obj) is numpy.ndarray:
-            return str(obj.shape)
-        return str(len(obj))
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return "list of 0", 0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            def records():
+                mapped.seek(0)
+                return rtype_file_records(mapped, format, encoding)
+
+            total = None
+            if limit is not None:
+                raw = islice(records(), limit)
+            elif sample is not None:
+                total = sum(1 for record in records())
+                raw = records()
+                if total > sample:
+                    raw = rtype_select(raw, engine.sample_indices(total))
+            else:
+                raw = records()
+            parsed = map(rtype_file_parsers[format], raw)
+            result = engine.describe_stream(parsed, total)
+            return result, engine.streamed, mapped.tell()
+
+
+rtype_file_formats = {"jsonl": "jsonl", "ndjson": "jsonl", "json": "json",
+                      "csv": "csv", "tsv": "tsv"}
+
+
+def rtype_file_records(mapped, format, encoding="utf-8"):
+    """Yield the records in the mapped file unparsed: non-blank lines
+    of JSON Lines, lists of fields of CSV.  The first CSV record is the
+    header, made into a dict with each record by rtype_file_parsers.
 
-    def contents(obj):
-        """Return an iterable object with the contents of obj"""
-        if type(obj) in (list, tuple):
-            return obj
-        elif type(obj) in (set, frozenset):
-            return list(obj)
-        elif type(obj) is dict:
-            return [obj[k] for k in sorted(obj.keys())]
-        elif numpy and type(obj) is numpy.ndarray:
-            return obj.flat
+    """
+    lines = iter(mapped.readline, b"")
+    if format == "jsonl":
+        for line in lines:
+            if line.strip():
+                yield line
+        return
+    delimiter = "\t" if format == "tsv" else ","
+    rows = csv.reader((line.decode(encoding) for line in lines),
+                      delimiter=delimiter)
+    header = next(rows, None)
+    for row in rows:
+        if row:
+            yield header, row
+
+
+def csv_record(fields):
+    """Make a dict from a CSV header and row the way csv.DictReader
+    does, with None as key for extra fields and value for missing ones.
+
+    """
+    header, row = fields
+    record = dict(zip(header, row))
+    if len(row) > len(header):
+        record[None] = row[len(header):]
+    for key in header[len(row):]:
+        record[key] = None
+    return record
+
+
+rtype_file_parsers = {"jsonl": json.loads, "csv": csv_record, "tsv": csv_record}
+
+
+def rtype_select(items, indices):
+    """Yield the elements of items at the given sorted indices."""
+    indices = iter(indices)
+    wanted = next(indices, None)
+    for i, item in enumerate(items):
+        if i == wanted:
+            yield item
+            wanted = next(indices, None)
+            if wanted is None:
+                return
+
+
+class RecursiveType(object):
+    """A single recursive_type() call.  memo holds the description of
+    each container seen so far, open the depth of each container that
+    is being described, to recognize cycles.  Descriptions of
+    containers are RType, so equal ones are the same object.
+
+    Containers are described with an explicit stack of RTypeFrame, or
+    of RTypeRecordsFrame for records merged into a schema, rather than
+    by recursion, so any depth of nesting works.
+
+    """
+    def __init__(self, max=50, max_depth=None, sample=None, seed=None,
+                 schema=False):
+        if sample is not None and sample < 1:
+            raise ValueError("sample must be at least 1, not %r" % (sample,))
+        self.max = max
+        self.max_depth = max_depth
+        self.sample = sample
+        self.random = random.Random(seed)
+        self.schema = schema
+        # Sets of the types in the lists, which can be changed any time.
+        self.simple_types = set(recursive_type_simple_types)
+        self.buffer_types = set(recursive_type_buffer_types)
+        self.composite_types = set(recursive_type_composite_types)
+        self.memo = {}
+        # The RTypeSchema of records nested in records, like memo, and
+        # the RTypeSchema of each record that's been seen lately, by the
+        # (rtype, schema) of each key.
+        self.schemas = {}
+        self.shapes = {}
+        self.open = {}
+
+    def describe(self, obj, depth=0):
+        """Return the recursive type of obj, found at the given depth."""
+        stack = []
+        return self.run(stack, self.enter(obj, depth, stack))
+
+    def run(self, stack, result=None, keep=0):
+        """Describe the contents of the frames on stack, given result, the
+        description of the element last yielded by the top one, if any.
+        Frames are left as they're done with, apart from the bottom keep
+        of them.  Return the description of the last frame left.
+
+        """
+        while stack:
+            frame = stack[-1]
+            if result is not None:
+                frame.add(result)
+            el = next(frame.contents, frame)
+            if el is not frame:
+                result = self.enter(el, frame.element_depth, stack)
+                continue
+            if len(stack) <= keep:
+                return None
+            stack.pop()
+            result = self.leave(frame)
+            if frame.reach is not None and frame.reach < frame.depth:
+                self.reached(stack, frame.reach)
+        return result
+
+    def reached(self, stack, depth):
+        """Note a back-reference to the container at depth, found in the
+        container on top of stack, if any.
+
+        """
+        if stack:
+            stack[-1].reached(depth)
+
+    def memo_key(self, obj, depth):
+        """Descriptions cut off at max_depth depend on how deep the
+        container was found, so they're only reused at the same depth.
+
+        """
+        if self.max_depth is None:
+            return id(obj)
+        return id(obj), depth
+
+    def enter(self, obj, depth, stack):
+        """Return the description of obj if it can be given right away.
+        Otherwise push a frame for it on stack and return None.
+
+        """
+        if type(obj) in self.simple_types:
+            return type(obj).__name__
+        if type(obj) in self.buffer_types:
+            # Inside containers, bytes are like str: their length
+            # doesn't make them a different type.
+            if depth and type(obj) in (bytes, bytearray):
+                return type(obj).__name__
+            return rtype_buffer(obj)
+        if type(obj) not in self.composite_types and not (
+            numpy and isinstance(obj, numpy.ndarray)
+        ):
+            return type(obj).__name__
+        key = self.memo_key(obj, depth)
+        if key in self.memo:
+            return self.memo[key]
+        if (id(obj), depth) in self.memo:
+            return self.memo[id(obj), depth]
+        name = type(obj).__name__
+        if id(obj) in self.open:
+            self.reached(stack, self.open[id(obj)])
+            return "back-reference to %s at depth %d" % (name, self.open[id(obj)])
+        if numpy and isinstance(obj, numpy.ndarray) and obj.dtype.kind != "O":
+            result = "%s of %s %s" % (name, rtype_shape(obj), rtype_dtype(obj.dtype))
+            self.memo[key] = result
+            return result
+        if self.max_depth is not None and depth >= self.max_depth:
+            return "%s of %s …" % (name, rtype_shape(obj))
+
+        # Only contents that get sampled can come in any order.
+        els = rtype_contents(obj, ordered=self.sample is None
+                             or len(obj) <= self.sample)
+        if len(els) == 0:
+            return "%s of 0" % name
+        sampled = 0
+        if self.sample is not None and len(els) > self.sample:
+            els = self.sample_of(els)
+            sampled = len(els)
+        if (self.schema and type(obj) in (list, tuple)
+            and (self.max_depth is None or depth + 1 < self.max_depth)
+            and rtype_all_type(els, dict)):
+            self.open[id(obj)] = depth
+            frame = RTypeRecordsFrame(obj, depth, self.max, sampled)
+            frame.contents = self.records_values(frame, els)
+            stack.append(frame)
+            return None
+        first_type = type(els[0])
+        if first_type in recursive_type_simple_types and rtype_all_type(
+            els, first_type
+        ):
+            result = "%s of %s %s%s" % (name, rtype_shape(obj, sampled),
+                                        first_type.__name__,
+                                        rtype_sampled(sampled))
+            self.memo[key] = result
+            return result
+        self.open[id(obj)] = depth
+        stack.append(RTypeFrame(obj, depth, els, self.max, sampled))
         return None
 
-    if type(obj) in recursive_type_composite_types:
-        if types_equal(contents(obj)) and types_simple(contents(obj)):
-            return "%s of %s %s" % (name(obj), shape(obj), name(contents(obj)[0]))
-        elif rtypes_equal(contents(obj)):
-            return [
-                "%s of %s" % (name(obj), shape(obj)),
-                recursive_type(contents(obj)[0]),
-            ]
-        elif len(contents(obj)) > max:
-            return (
-                ["%s of" % name(obj)]
-                + [recursive_type(el) for el in contents(obj)[:max]]
-                + ["........"]
-            )
+    def describe_record(self, record, frame):
+        """Merge record, a dict found at frame.depth + 1, into
+        frame.records.  frame is an RTypeRecordsFrame without a
+        container, which can be used for any number of records.
+
+        """
+        frame.contents = self.record_values(frame, record)
+        self.run([frame], keep=1)
+
+    def record_values(self, frame, record):
+        """Merge record, a dict found at frame.depth + 1, into
+        frame.records.  Yield the values in it that aren't records or
+        simple, for describe() to describe and frame to add, setting
+        frame.node, frame.key and frame.element_depth to where each one
+        was found.
+
+        A record nested in record is only merged once however many times
+        it's found, and one that contains itself gets a back-reference.
+        The descriptions and schemas of what's in record are forgotten
+        afterwards, so that memory use depends on the size of the
+        schema, not of the records.
+
+        """
+        marks = len(self.memo), len(self.schemas)
+        simple_types, opened, schemas = self.simple_types, self.open, self.schemas
+        depth = frame.depth + 1
+        opened[id(record)] = depth
+        stack = [RTypeRecordNode(record, depth)]
+        while True:
+            node = stack[-1]
+            fields = node.fields
+            for key, value in node.items:
+                if type(value) in simple_types:
+                    fields[key] = (type(value).__name__, None)
+                elif type(value) is not dict:
+                    frame.node, frame.key = node, key
+                    frame.element_depth = node.depth + 1
+                    yield value
+                elif id(value) in opened:
+                    found = opened[id(value)]
+                    node.reached(found)
+                    fields[key] = ("back-reference to dict at depth %d" % found,
+                                   None)
+                else:
+                    schema = schemas.get(id(value))
+                    if schema is None:
+                        schema = schemas.get((id(value), node.depth + 1))
+                    if schema is None:
+                        node.key = key
+                        opened[id(value)] = node.depth + 1
+                        stack.append(RTypeRecordNode(value, node.depth + 1))
+                        break
+                    fields[key] = (None, schema)
+            else:
+                stack.pop()
+                del opened[id(node.record)]
+                schema = self.record_shape(fields)
+                if not stack:
+                    break
+                # As in leave()
+                if node.reach is None:
+                    schemas[self.memo_key(node.record, node.depth)] = schema
+                elif node.reach >= node.depth:
+                    schemas[id(node.record), node.depth] = schema
+                parent = stack[-1]
+                parent.fields[parent.key] = (None, schema)
+                if node.reach is not None and node.reach < node.depth:
+                    parent.reached(node.reach)
+        frame.node = None
+        if node.reach is not None and node.reach < node.depth:
+            frame.reached(node.reach)
+        frame.records.add(schema)
+        while len(self.memo) > marks[0]:
+            self.memo.popitem()
+        while len(schemas) > marks[1]:
+            schemas.popitem()
+
+    def records_values(self, frame, records):
+        """Merge records, each a dict, into frame.records, yielding what
+        record_values() does.
+
+        """
+        for record in records:
+            yield from self.record_values(frame, record)
+
+    def record_shape(self, fields):
+        """Return the RTypeSchema of a record given the (rtype, schema)
+        of the value of each of its keys.  Records with the same keys
+        and types get the same one.
+
+        """
+        shape = tuple(fields.items())
+        schema = self.shapes.get(shape)
+        if schema is not None:
+            return schema
+        if len(self.shapes) >= recursive_type_shapes:
+            self.shapes.clear()
+        schema = RTypeSchema(self.max, 1, {
+            key: RTypeField(self.max, rtype, records)
+            for key, (rtype, records) in fields.items()})
+        self.shapes[shape] = schema
+        return schema
+
+    def sample_indices(self, n):
+        """Return the indices of the elements of a container of n to
+        look at: the first and last and a random selection of the
+        others, self.sample in all, in order.
+
+        """
+        if self.sample == 1:
+            return [0]
+        middle = sorted(self.random.sample(range(1, n - 1), self.sample - 2))
+        return [0] + middle + [n - 1]
+
+    def sample_of(self, els):
+        """Return the elements of els at sample_indices()."""
+        indices = self.sample_indices(len(els))
+        if numpy and isinstance(els, numpy.ndarray):
+            return els[indices]
+        return [els[i] for i in indices]
+
+    def describe_stream(self, items, total=None, name="list"):
+        """Return the recursive type of a list with the elements yielded
+        by items, without keeping them.  If the list has been sampled,
+        total is the size of the whole list.  The number of elements
+        described is left in self.streamed.
+
+        Elements are forgotten as soon as they're described, so the memo
+        is cleared for each one: another object could get the same id.
+
+        """
+        summary = self.summarize(items, forget=True)
+        self.streamed = summary.count
+        if summary.count == 0:
+            return "%s of 0" % name
+        sampled = 0
+        if total is not None and total > summary.count:
+            sampled = summary.count
+        shape = rtype_size(total or summary.count, sampled)
+        if self.max_depth is not None and self.max_depth <= 0:
+            return "%s of %s …" % (name, shape)
+        return self.finish(summary, name, shape, sampled)
+
+    def summarize(self, items, forget=False):
+        """Describe the elements yielded by items, at depth 1, and fold
+        them into an RTypeSummary.  If forget, clear the memo for each
+        element, which is dropped after it's described.
+
+        """
+        records = None
+        if self.schema and (self.max_depth is None or 1 < self.max_depth):
+            records = RTypeRecordsFrame(None, 0, self.max)
+        summary = RTypeSummary(self.max)
+        for el in items:
+            if forget:
+                self.memo.clear()
+            if records is not None and type(el) is dict:
+                self.describe_record(el, records)
+            else:
+                records = None
+            summary.add(el, self.describe(el, 1))
+        if forget:
+            self.memo.clear()
+        if records is not None:
+            summary.records = records.records.total()
+        return summary
+
+    def finish(self, summary, name, shape, sampled=0, records=True):
+        """Describe a container of type name and shape from the summary
+        of its contents.  Only if records is it described as a schema.
+
+        """
+        summary.frame.sampled = sampled
+        if records and summary.records is not None:
+            return summary.records.render("%s of %s records%s" % (
+                name, shape, rtype_sampled(sampled)))
+        if summary.simple and summary.first_type in self.simple_types:
+            return "%s of %s %s%s" % (name, shape, summary.first_type.__name__,
+                                      rtype_sampled(sampled))
+        return self.render(summary.frame, name, shape)
+
+    def describe_parallel(self, obj, processes=0):
+        """Describe obj by splitting its contents into chunks summarized
+        by a pool of processes.  Return None if obj is too small for that
+        to be worth it, or isn't a container that can be split.
+
+        """
+        if type(obj) not in self.composite_types and not (
+            numpy and isinstance(obj, numpy.ndarray) and obj.dtype.kind == "O"
+        ):
+            return None
+        if self.max_depth is not None and self.max_depth <= 0:
+            return None
+        els = rtype_contents(obj)
+        if len(els) < max(recursive_type_parallel_threshold, 2):
+            return None
+        processes = processes or os.cpu_count() or 1
+        size = -(-len(els) // (4 * processes))
+        bounds = [(start, min(start + size, len(els)))
+                  for start in range(0, len(els), size)]
+        options = (self.max, self.max_depth, self.schema)
+
+        global rtype_parallel_contents
+        shared = None
+        if recursive_type_parallel_fork:
+            # Workers read the contents from the memory they inherit.
+            context = multiprocessing.get_context("fork")
+            rtype_parallel_contents = (obj, els)
+            tasks = [(options, bounds, None, None) for bounds in bounds]
+        else:
+            context = multiprocessing.get_context("spawn")
+            shared = RTypeSharedBuffers(els)
+            tasks = [(options, None, shared.pack(els[start:stop]), shared.name)
+                     for start, stop in bounds]
+        try:
+            try:
+                tasks = [pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+                         for task in tasks]
+            except (pickle.PicklingError, TypeError, AttributeError,
+                    RecursionError):
+                # Some elements can only be described here.
+                return None
+            with context.Pool(processes) as pool:
+                summaries = pool.map(rtype_summarize_chunk, tasks)
+        finally:
+            rtype_parallel_contents = None
+            if shared is not None:
+                shared.close()
+
+        # RTypes unpickled from the workers are interned here.
+        summary = summaries[0]
+        for other in summaries[1:]:
+            summary.merge(other)
+        result = self.finish(summary, type(obj).__name__, rtype_shape(obj),
+                             records=type(obj) in (list, tuple))
+        self.memo[self.memo_key(obj, 0)] = result
+        return result
+
+    def leave(self, frame):
+        """Return the description of the container in frame, now that
+        all of its contents have been described.
+
+        """
+        del self.open[id(frame.obj)]
+        name = type(frame.obj).__name__
+        shape = rtype_shape(frame.obj, frame.sampled)
+        if type(frame) is RTypeRecordsFrame:
+            result = frame.records.total().render("%s of %s records%s" % (
+                name, shape, rtype_sampled(frame.sampled)))
+        else:
+            result = self.render(frame, name, shape)
+        # A description that refers to a container outside itself
+        # depends on where it was reached from, so it isn't remembered.
+        # One that refers back to the container itself gives the depth
+        # it was found at, so it's only reused at that depth.
+        if frame.reach is None:
+            self.memo[self.memo_key(frame.obj, frame.depth)] = result
+        elif frame.reach >= frame.depth:
+            self.memo[id(frame.obj), frame.depth] = result
+        return result
+
+    def render(self, frame, name, shape):
+        """Describe a container of type name and shape, from frame."""
+        sampled = rtype_sampled(frame.sampled)
+        if frame.all_equal:
+            result = ["%s of %s%s" % (name, shape, sampled), frame.first]
+        elif frame.count > self.max or frame.sampled:
+            result = ["%s of%s" % (name, sampled)] + frame.listed + ["........"]
+        else:
+            result = ["%s of" % name] + frame.listed
+        return RType(result)
+
+
+class RType(object):
+    """The recursive type of a container, as returned by
+    recursive_type(signature=True): a header string followed by the
+    recursive types of the contents, each a str or another RType.
+
+    RTypes are immutable and interned: there is only ever one RType
+    with given parts, so that equal RTypes are the same object, and
+    compare and hash in constant time however deep they are.  The same
+    substructure found in different places is shared.  render() gives
+    the nested lists that recursive_type() returns by default.
+
+    >>> a = recursive_type([[1, 'a'], [2, 'b']], signature=True)
+    >>> a
+    RType('list of 2')
+    >>> a.render()
+    ['list of 2', ['list of', 'int', 'str']]
+    >>> a[1] is recursive_type([3, 'c'], signature=True)
+    True
+
+    """
+    __slots__ = ("parts", "__weakref__")
+
+    def __new__(cls, parts):
+        parts = tuple(parts)
+        # Parts that are RType are themselves interned, so they hash
+        # and compare by identity and the key is cheap to look up.
+        rtype = rtype_interned.get(parts)
+        if rtype is None:
+            rtype = object.__new__(cls)
+            object.__setattr__(rtype, "parts", parts)
+            rtype_interned[parts] = rtype
+        return rtype
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RType is immutable")
+
+    def __reduce__(self):
+        # Unpickled RTypes, from worker processes, are interned again.
+        return RType, (self.parts,)
+
+    def __repr__(self):
+        # Only the header, since the parts may nest too deep to print.
+        return "RType(%r)" % (self.header,)
+
+    def __len__(self):
+        return len(self.parts)
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __getitem__(self, index):
+        return self.parts[index]
+
+    @property
+    def header(self):
+        """The description of the container itself, without contents."""
+        return self.parts[0]
+
+    def render(self):
+        """Return the nested lists that describe the same recursive type,
+        in which the same RType gives the same list.
+
+        """
+        rendered = {}
+        stack = [self]
+        while stack:
+            rtype = stack[-1]
+            if id(rtype) in rendered:
+                stack.pop()
+                continue
+            pending = [part for part in rtype.parts
+                       if type(part) is RType and id(part) not in rendered]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            rendered[id(rtype)] = [
+                part if type(part) is str else rendered[id(part)]
+                for part in rtype.parts]
+        return rendered[id(self)]
+
+
+rtype_interned = weakref.WeakValueDictionary()
+
+
+def rtype_render(rtype):
+    """Return rtype, a result of RecursiveType, as recursive_type()
+    does by default: a str, or nested lists.
+
+    """
+    return rtype if type(rtype) is str else rtype.render()
+
+
+class RTypeSummary(object):
+    """What recursive_type() needs to know about the contents of a
+    container: how many elements, whether they're all of the same type
+    (first_type), an RTypeFrame with their descriptions, and, while all
+    of them are dicts, an RTypeSchema of them, or None.  Summaries of
+    consecutive parts of a container merge into the summary of the
+    whole.
+
+    """
+    def __init__(self, max=50, records=None):
+        self.count = 0
+        self.first_type = None
+        self.simple = True
+        self.frame = RTypeFrame(None, 0, (), max)
+        self.records = records
+
+    def add(self, el, rtype):
+        """Take the next element and its description into account."""
+        if self.count == 0:
+            self.first_type = type(el)
+        elif self.simple and type(el) is not self.first_type:
+            self.simple = False
+        self.frame.add(rtype)
+        self.count += 1
+
+    def merge(self, other):
+        """Add the summary of the elements following these."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return
+        self.simple = (self.simple and other.simple
+                       and other.first_type is self.first_type)
+        self.frame.merge(other.frame)
+        if self.records is not None and other.records is not None:
+            self.records = rtype_merge_schemas(self.records, other.records)
+        else:
+            self.records = None
+        self.count += other.count
+
+
+def rtype_summarize_chunk(task):
+    """Summarize a chunk of a container in a worker process.  task is
+    the pickled (options, bounds, els, name): the max, max_depth and
+    schema arguments of RecursiveType, and either the start and stop of
+    the chunk in rtype_parallel_contents, or the elements of the chunk,
+    with buffers in the shared memory called name.
+
+    """
+    options, bounds, els, name = pickle.loads(task)
+    max, max_depth, schema = options
+    engine = RecursiveType(max=max, max_depth=max_depth, schema=schema)
+    if els is None:
+        obj, contents = rtype_parallel_contents
+        engine.open[id(obj)] = 0
+        els = islice(contents, *bounds)
+    elif name is not None:
+        memory = shared_memory.SharedMemory(name)
+        try:
+            els = [el.unpack(memory.buf) if type(el) is RTypeSharedBuffer
+                   else el for el in els]
+        finally:
+            memory.close()
+    summary = engine.summarize(els)
+    # Only simple types matter, and other classes may not pickle.
+    if summary.first_type not in engine.simple_types:
+        summary.first_type = None
+        summary.simple = False
+    return summary
+
+
+class RTypeSharedBuffers(object):
+    """The elements of a container that are buffers, copied into one
+    block of shared memory for describe_parallel() to hand them to its
+    workers without pickling them.  name is that of the block, or None
+    if there are no such elements.
+
+    """
+    def __init__(self, els):
+        self.name = None
+        self.memory = None
+        self.layouts = {}
+        offset = 0
+        for el in els:
+            layout = rtype_shared_layout(el)
+            if layout is not None and id(el) not in self.layouts:
+                self.layouts[id(el)] = (offset, layout)
+                offset += layout[-1].nbytes
+        if not self.layouts:
+            return
+        self.memory = shared_memory.SharedMemory(create=True, size=offset or 1)
+        self.name = self.memory.name
+        for offset, layout in self.layouts.values():
+            data = layout[-1]
+            self.memory.buf[offset:offset + data.nbytes] = data
+
+    def pack(self, els):
+        """Return els with each buffer replaced by an RTypeSharedBuffer."""
+        packed = []
+        for el in els:
+            found = self.layouts.get(id(el))
+            if found is None:
+                packed.append(el)
+                continue
+            offset, layout = found
+            packed.append(RTypeSharedBuffer(offset, *layout))
+        return packed
+
+    def close(self):
+        """Release the shared memory."""
+        self.layouts = {}
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+
+def rtype_shared_layout(el):
+    """Return (kind, details, data) if el is a buffer that
+    RTypeSharedBuffer can rebuild from data, a contiguous memoryview of
+    its bytes, or None if el is to be pickled.
+
+    """
+    try:
+        if type(el) in (bytes, bytearray):
+            return type(el).__name__, None, memoryview(el).cast("B")
+        if type(el) is array.array:
+            return "array", el.typecode, memoryview(el).cast("B")
+        if numpy and type(el) is numpy.ndarray and el.dtype.kind != "O":
+            data = memoryview(numpy.ascontiguousarray(el).reshape(-1).view(numpy.uint8))
+            return "ndarray", (el.dtype, el.shape), data
+        if type(el) is memoryview and el.c_contiguous:
+            data = el.cast("B")
+            data.cast(el.format, el.shape)
+            return "memoryview", (el.format, el.shape, el.readonly), data
+    except (TypeError, ValueError, BufferError):
+        pass
+    return None
+
+
+class RTypeSharedBuffer(object):
+    """A buffer copied to shared memory by RTypeSharedBuffers, at
+    offset, as described by rtype_shared_layout().
+
+    """
+    def __init__(self, offset, kind, details, data):
+        self.offset = offset
+        self.size = data.nbytes
+        self.kind = kind
+        self.details = details
+
+    def unpack(self, buf):
+        """Return a copy of the buffer from buf, the shared memory."""
+        data = bytes(buf[self.offset:self.offset + self.size])
+        if self.kind == "bytes":
+            return data
+        if self.kind == "bytearray":
+            return bytearray(data)
+        if self.kind == "array":
+            el = array.array(self.details)
+            el.frombytes(data)
+            return el
+        if self.kind == "ndarray":
+            dtype, shape = self.details
+            return numpy.frombuffer(data, numpy.uint8).view(dtype).reshape(shape)
+        format, shape, readonly = self.details
+        return memoryview(data if readonly else bytearray(data)).cast(format, shape)
+
+
+# The container and its contents, while describe_parallel() runs.
+rtype_parallel_contents = None
+
+
+class RTypeSchema(object):
+    """The keys of count records (dicts), in the order they were first
+    seen, each with an RTypeField.  Schemas aren't changed once made:
+    rtype_merge_schemas() makes a new one, so that a schema can be
+    shared by every record that has it.  Memory use depends on the
+    number of different keys and value types, not of records.
+
+    """
+    def __init__(self, max=50, count=0, fields=None):
+        self.max = max
+        self.count = count
+        self.fields = {} if fields is None else fields
+
+    def render(self, header):
+        """Return the schema as an RType starting with header."""
+        # Nested schemas are rendered innermost first, each once as the
+        # list of its fields, which the field holding it adds a header
+        # to.
+        rendered = {}
+        stack = [self]
+        while stack:
+            schema = stack[-1]
+            if id(schema) in rendered:
+                stack.pop()
+                continue
+            pending = [field.records for field in schema.fields.values()
+                       if field.records is not None
+                       and id(field.records) not in rendered]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            rendered[id(schema)] = [
+                field.render(str(key), schema.count, rendered)
+                for key, field in schema.fields.items()]
+        return RType([header] + rendered[id(self)])
+
+
+def rtype_merge_schemas(first, second, times=1):
+    """Return the RTypeSchema of the records of first followed by times
+    those of second.  Each pair of schemas nested in them is merged
+    once, however many times it's found.
+
+    """
+    # Where second has a nested schema that first hasn't, it's merged
+    # with empty, unless it can be used as it is.
+    empty = RTypeSchema(first.max)
+    no_field = RTypeField(first.max)
+    no_field.count = 0
+    merged = {}
+    stack = [(first, second)]
+    while stack:
+        a, b = stack[-1]
+        if (id(a), id(b)) in merged:
+            stack.pop()
+            continue
+        pending = []
+        for key, field in b.fields.items():
+            if field.records is None:
+                continue
+            mine = a.fields.get(key, no_field).records
+            if mine is None and times == 1:
+                continue
+            pair = (mine or empty, field.records)
+            if (id(pair[0]), id(pair[1])) not in merged:
+                pending.append(pair)
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        fields = dict(a.fields)
+        for key, field in b.fields.items():
+            mine = fields.get(key)
+            if mine is None and times == 1:
+                fields[key] = field
+            else:
+                fields[key] = (mine or no_field).merged(field, merged, times, empty)
+        merged[id(a), id(b)] = RTypeSchema(a.max, a.count + b.count * times, fields)
+    return merged[id(first), id(second)]
+
+
+class RTypeField(object):
+    """One key of an RTypeSchema: how many records have it, the
+    different recursive types of its values, as the keys of union, and
+    an RTypeSchema for the values that are dicts.  Only max different
+    types are kept.  A new field is that of one record, with the value
+    rtype or with the record records.
+
+    """
+    def __init__(self, max=50, rtype=None, records=None):
+        self.max = max
+        self.count = 1
+        self.union = {} if rtype is None else {rtype: True}
+        self.more = False
+        self.records = records
+
+    def merged(self, other, schemas, times=1, empty=None):
+        """Return the field of the values of this key followed by times
+        those of other.  schemas maps the ids of pairs of nested schemas
+        to their merge, with empty standing for a missing one.
+
+        """
+        field = RTypeField(self.max)
+        field.count = self.count + other.count * times
+        field.union = dict(self.union)
+        field.more = self.more or other.more
+        for rtype in other.union:
+            if rtype in field.union:
+                continue
+            if len(field.union) < self.max:
+                field.union[rtype] = True
+            else:
+                field.more = True
+        if other.records is None:
+            field.records = self.records
+        elif self.records is None and times == 1:
+            field.records = other.records
         else:
-            return ["%s of" % name(obj)] + [recursive_type(el) for el in contents(obj)]
-    return name(obj)
+            field.records = schemas[id(self.records or empty), id(other.records)]
+        return field
+
+    def render(self, name, total, rendered):
+        """Describe the field name, in total records, as a string if its
+        values have simple types and as an RType otherwise.  rendered
+        maps the id of the nested RTypeSchema to its rendered fields.
+
+        """
+        note = ""
+        if self.count < total:
+            note = " (optional, %d of %d)" % (self.count, total)
+        rtypes = list(self.union)
+        if self.more:
+            rtypes.append("........")
+        if self.records is None and all(type(rtype) is str for rtype in rtypes):
+            return "%s: %s%s" % (name, " | ".join(rtypes), note)
+        if self.records is None:
+            return RType(["%s:%s" % (name, note)] + rtypes)
+        records = rendered[id(self.records)]
+        if not rtypes:
+            return RType(["%s: record%s" % (name, note)] + records)
+        rtypes.append(RType(["record"] + records))
+        return RType(["%s:%s" % (name, note)] + rtypes)
+
+
+class RTypeSchemaTotal(object):
+    """Merges the schemas of many records, in order.  Records usually
+    have one of a few schemas, and RecursiveType makes equal ones the
+    same object, so each is counted and only merged once for every
+    batch of records.
+
+    """
+    # Number of different schemas in a batch
+    batch = 1000
+
+    def __init__(self, max=50):
+        self.schema = RTypeSchema(max)
+        self.pending = {}
+
+    def add(self, schema):
+        """Merge in the schema of the next record."""
+        entry = self.pending.get(id(schema))
+        if entry is not None:
+            entry[1] += 1
+            return
+        self.pending[id(schema)] = [schema, 1]
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Merge the pending schemas into schema, in the order they were
+        first added, which is that of their keys and types.
+
+        """
+        for schema, times in self.pending.values():
+            self.schema = rtype_merge_schemas(self.schema, schema, times)
+        self.pending = {}
+
+    def total(self):
+        """Return the RTypeSchema of all of the records."""
+        self.flush()
+        return self.schema
+
+
+class RTypeRecordsFrame(object):
+    """A list or tuple of records (dicts) that recursive_type() is
+    merging into records, an RTypeSchemaTotal, or a single record if obj
+    is None.  contents yields the values in them, and in the records
+    nested in them, that need describing; node, key and element_depth
+    say where the value yielded last was found.  reach, depth and
+    sampled are as in RTypeFrame.
+
+    """
+    def __init__(self, obj, depth, max=50, sampled=0):
+        self.obj = obj
+        self.depth = depth
+        self.sampled = sampled
+        self.records = RTypeSchemaTotal(max)
+        self.contents = iter(())
+        self.node = None
+        self.key = None
+        self.element_depth = depth + 1
+        self.reach = None
+
+    def add(self, rtype):
+        """Take the description of the value yielded last into account."""
+        self.node.fields[self.key] = (rtype, None)
+
+    def reached(self, depth):
+        """Note a back-reference to the container at depth, found in the
+        record being merged, if any.
+
+        """
+        if self.node is not None:
+            self.node.reached(depth)
+        elif self.reach is None or depth < self.reach:
+            self.reach = depth
+
+
+class RTypeRecordNode(object):
+    """A record that an RTypeRecordsFrame is merging: the dict, found at
+    depth, an iterator over its items, the (rtype, schema) of the value
+    of each key done so far, and the key of the nested record being
+    merged, if any.  reach is as in RTypeFrame.
+
+    """
+    __slots__ = ("record", "depth", "items", "fields", "key", "reach")
+
+    def __init__(self, record, depth):
+        self.record = record
+        self.depth = depth
+        self.items = iter(record.items())
+        self.fields = {}
+        self.key = None
+        self.reach = None
+
+    def reached(self, depth):
+        """Note a back-reference to the container at depth."""
+        if self.reach is None or depth < self.reach:
+            self.reach = depth
+
+
+class RTypeFrame(object):
+    """A container that recursive_type() is describing.  Rather than the
+    description of every element, only keep the first one, whether all
+    are equal, and the first max of them, which is all that's shown.
+
+    reach is the shallowest depth that a back-reference found inside
+    the container points to.  sampled is the number of elements looked
+    at if the container is only sampled, otherwise 0.
+
+    """
+    __slots__ = ("obj", "depth", "contents", "max", "sampled", "count",
+                 "first", "all_equal", "listed", "reach")
+
+    def __init__(self, obj, depth, contents, max, sampled=0):
+        self.obj = obj
+        self.depth = depth
+        self.sampled = sampled
+        self.contents = iter(contents)
+        self.max = max
+        self.count = 0
+        self.first = None
+        self.all_equal = True
+        self.listed = []
+        self.reach = None
+
+    def add(self, rtype):
+        """Take the description of the next element into account."""
+        if self.count == 0:
+            self.first = rtype
+        elif self.all_equal and rtype != self.first:
+            self.all_equal = False
+        if self.count < self.max:
+            self.listed.append(rtype)
+        self.count += 1
+
+    def merge(self, other):
+        """Add the descriptions in other, the frame of the elements that
+        follow these.
+
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.first, self.all_equal = other.first, other.all_equal
+        elif self.all_equal and (not other.all_equal or other.first != self.first):
+            self.all_equal = False
+        self.listed.extend(other.listed[:self.max - len(self.listed)])
+        self.count += other.count
+
+    @property
+    def element_depth(self):
+        """The depth of the elements of the container."""
+        return self.depth + 1
+
+    def reached(self, depth):
+        """Note a back-reference to the container at depth."""
+        if self.reach is None or depth < self.reach:
+            self.reach = depth
+
+
+def rtype_shape(obj, approximate=False):
+    """Return the shape of obj as recursive_type() shows it, only
+    roughly if approximate, as in ~1e8 or ~2.5e4.
+
+    """
+    if numpy and isinstance(obj, numpy.ndarray):
+        return str(obj.shape)
+    return rtype_size(len(obj), approximate)
+
+
+def rtype_size(n, approximate=False):
+    """Return n, only roughly if approximate."""
+    if approximate and n < 1000:
+        return "~%d" % n
+    elif approximate:
+        mantissa, exponent = ("%.1e" % n).split("e")
+        return "~%se%d" % (mantissa.rstrip("0").rstrip("."), int(exponent))
+    return str(n)
+
+
+def rtype_sampled(sampled):
+    """Return the note added to the description of a sampled container."""
+    if sampled:
+        return " (sampled %d)" % sampled
+    return ""
+
+
+def rtype_contents(obj, ordered=True):
+    """Return a sequence with the contents of container obj, in the
+    order recursive_type() looks at them: dict values by key.  If not
+    ordered, dict values come in whatever order is quickest.
+
+    """
+    if type(obj) in (list, tuple):
+        return obj
+    elif type(obj) in (set, frozenset):
+        return list(obj)
+    elif type(obj) is dict:
+        if not ordered:
+            return list(obj.values())
+        try:
+            keys = sorted(obj.keys())
+        except TypeError:
+            keys = list(obj.keys())
+        return [obj[k] for k in keys]
+    elif numpy and isinstance(obj, numpy.ndarray):
+        return obj.reshape(-1)
+    return None
+
+
+def rtype_dtype(dtype):
+    """Describe the elements of an array with the given dtype, as in
+    float64, or record(x float64, y (2,) int32) for structured arrays.
+
+    """
+    if dtype.fields is not None:
+        return "record(%s)" % ", ".join(
+            "%s %s" % (field, rtype_dtype(dtype.fields[field][0]))
+            for field in dtype.names)
+    if dtype.subdtype is not None:
+        base, shape = dtype.subdtype
+        return "%s %s" % (shape, rtype_dtype(base))
+    return dtype.type.__name__
+
+
+def rtype_buffer(obj):
+    """Describe obj through the buffer protocol, as in 'array of (100,)
+    float64' or 'memoryview of (3, 4) uint8 readonly non-contiguous'.
+    Objects that can't give a buffer just get their type name.
+
+    """
+    name = type(obj).__name__
+    try:
+        with memoryview(obj) as view:
+            shape, readonly = view.shape, view.readonly
+            contiguous = view.contiguous
+            element = rtype_format(view.format, view.itemsize)
+    except (TypeError, ValueError, BufferError):
+        return name
+    flags = ""
+    # bytes are always read-only, so only mention it for the others.
+    if readonly and type(obj) is not bytes:
+        flags += " readonly"
+    if not contiguous:
+        flags += " non-contiguous"
+    return "%s of %s %s%s" % (name, shape, element, flags)
+
+
+def rtype_format(format, itemsize):
+    """Name the elements of a buffer with the given struct format the
+    way numpy names dtypes, falling back to the format itself.
+
+    """
+    code = format.lstrip("@=<>!")
+    if code in ("b", "h", "i", "l", "q", "n"):
+        return "int%d" % (8 * itemsize)
+    elif code in ("B", "H", "I", "L", "Q", "N"):
+        return "uint%d" % (8 * itemsize)
+    elif code in ("e", "f", "d"):
+        return "float%d" % (8 * itemsize)
+    elif code == "?":
+        return "bool"
+    elif code in ("u", "w"):
+        return "str"
+    return format
+
+
+def rtype_all_type(els, kind):
+    """Return True if all of els are of type kind.  Object arrays are
+    checked with numpy rather than one element at a time.
+
+    """
+    if numpy and isinstance(els, numpy.ndarray):
+        # Wrapped in an array so that numpy doesn't take kind for a dtype.
+        kinds = numpy.array([kind], dtype=object)
+        return bool((rtype_types(els) == kinds).all())
+    return all(type(el) is kind for el in els)
+
+
+if numpy:
+    # The type of each element of an object array, as an array.
+    rtype_types = numpy.frompyfunc(type, 1, 1)
 
 
 ##################################################
@@ -259,28 +1867,137 @@ def apropos(needle, haystack=None, name=None, search=None, **kw):
 
     Matches determined by search.  search(needle, name, obj) returns
     true if the object should be considered a match.  By default,
-    search matches if needle is a substring of the name of the object.
+    search matches if needle is a substring of the name of the object,
+    or if needle is a Query, if the query matches (see apropos_query()).
+    If search has a prepare attribute, search.prepare(needle) is called
+    once instead, and the function match(name, obj) it returns is used
+    for every object (see prepare_search()).  If it has a
+    prepare_descend attribute, search.prepare_descend(needle) returns
+    None or a function descend(obj), and only the objects for which it
+    is true are searched inside.
+
+    The search can be limited with max_depth (number of levels),
+    max_nodes (number of objects examined), max_results (number of
+    matches) and time_limit (seconds).  max_children limits the number
+    of elements searched in any one list, tuple or dict: the first
+    max_children of them, or a random selection if sample='random' (see
+    select_children()).
+
+    The value searches look at the first value_limit characters of the
+    string of each object, apropos_value_limit by default, and skip
+    objects that would take too long to turn into a string.  The result
+    lists these objects (see render_value()).
+
+    Modules are always searched.  With instances=True, instances of
+    user classes, including dataclasses and namedtuples, are searched
+    too.  Their attributes are read directly from __dict__ and
+    __slots__, so properties and __getattr__ aren't triggered.  With
+    static=False, modules and instances are searched with dir() and
+    getattr() instead, which finds class attributes and lazily loaded
+    attributes too, but runs whatever code getting them involves.
+
+    Return a list of strings showing the path to reach the matching
+    object.  The list is an AproposResult, which also says whether the
+    search was cut short by one of the limits.  Use AproposSearch
+    directly for a search that can be resumed.
+
+    If the search is interrupted with Ctrl-C, return the matches
+    found so far.
+
+    """
+    return AproposSearch(needle, haystack, name, search, **kw).run()
+
+
+def iapropos(needle, haystack=None, name=None, search=None, **kw):
+    """Iterator version of apropos().  Arguments are the same as for
+    apropos().
+
+    Return an iterator over strings showing the path to reach each
+    matching object.  Matches come out in the same order as the list
+    returned by apropos(), as soon as they're found, and the search
+    only goes as far as the caller keeps asking for results:
+
+    >>> next(iapropos('cmap', matplotlib))
+    'matplotlib.cm.cmapname'
+
+    """
+    return iter(AproposSearch(needle, haystack, name, search, **kw))
+
+
+def apropos_query(query, haystack=None, **kw):
+    """Recursively search for objects matching query, a Query that
+    combines conditions on the name, type, docstring or value of
+    objects with & (and), | (or) and ~ (not).  See apropos() for
+    additional keyword arguments.
+
+    Conditions are checked cheapest first, and only as far as needed
+    to know the answer, so in Name('cmap') & Doc('colormap') the
+    docstring is only searched for objects named cmap-something.  With
+    Within(), the search doesn't go inside containers of other types.
+
+    >>> apropos_query(Name('cmap') & Type(str), matplotlib)
+    >>> apropos_query((Name('lr') | Name('learning_rate')) & ~Type(str)
+    ...               & Within(dict, types.ModuleType), trainer)
 
     Return a list of strings showing the path to reach the matching
     object
 
     """
-    if haystack is None:
-        # TODO Think this is wrong.  Want call to globals to be from user's
-        # namespace, not the module space here.  Is there a way to
-        # climb up the call stack and steal it from them?  Probably...
-        haystack = globals()
-        name = ""
-    elif name is None:
-        if hasattr(haystack, "__name__"):
-            name = haystack.__name__
-        else:
-            name = "arg"
+    return apropos(query, haystack, search=search_query, **kw)
+
+
+def apropos_array(needle, haystack=None, name=None, **kw):
+    """Recursively search for numpy arrays with elements matching
+    needle, comparing all of the elements of each array at once.  needle
+    is one of:
+
+    a number : elements equal to it, or NaN for NaN elements
+    Near(value, tolerance) : numbers within tolerance of value
+    a str or bytes : elements of str or bytes arrays containing it
+    a function : one that takes an array and returns a boolean array of
+        the same shape, such as numpy.isinf or lambda a: ~numpy.isfinite(a)
+
+    Arrays that needle can't be compared with, because of their dtype,
+    don't match.  See apropos() for additional keyword arguments.
+
+    Return an AproposResult of (path, indices) pairs, with the string
+    showing the path to reach each matching array and the indices of
+    the matching elements in it, as numpy.argwhere() gives them.
+
+    >>> apropos_array(numpy.isnan, state)
+    [('state.solver.residuals', array([[1041]]))]
 
-    if search is None:
-        search = search_name
+    """
+    searcher = AproposArraySearch(needle, haystack, name, **kw)
+    matches = searcher.run()
+    result = AproposResult((match, searcher.indices[match]) for match in matches)
+    result.status_from(matches)
+    return result
+
+
+def apropos_many(needles, haystack=None, name=None, search=None, **kw):
+    """Search for each of needles in one pass through haystack.  The
+    other arguments are the same as for apropos(), and the limits apply
+    to the search as a whole: max_results counts objects matching any
+    needle.
 
-    return _apropos(needle, haystack, name, search, **kw)
+    Return a list with the AproposResult of each needle, the list of
+    paths to the objects that match it, in the order of needles.
+
+    Each object is examined once, and the search functions in this
+    module look for all of the needles together (see prepare_many()),
+    so this takes little longer than searching for one of them.
+
+    >>> cmap, norm = apropos_many(['cmap', 'norm'], matplotlib)
+    >>> norm
+    ['matplotlib.colors.Normalize', ...]
+
+    """
+    searcher = AproposManySearch(needles, haystack, name, search, **kw)
+    searcher.run()
+    for result in searcher.results:
+        result.status_from(searcher.result)
+    return searcher.results
 
 
 ##############################
@@ -299,68 +2016,14 @@ def search_value(needle, name, obj):
     # TODO What I really want to do is match the container if none of
     # its contents matched.
     if type(obj) not in (tuple, list, dict):
-        return needle in str(obj)
+        text = render_value(obj)[0]
+        return text is not None and needle in text
         # NOTE -- should be repr() above?
 
 
 def search_equal(needle, name, obj):
     """Match if needle is equal to obj"""
-    # This was more annoying than I thought, as we're walking through
-    # all objects in memory and some of them have poorly written
-    # __cmp__ functions that throw exceptions instead of returning
-    # False
-    #
-    # as of March 2013, for my system, the value
-    # matplotlib.finance.stock_dt also causes problems.  This is a
-    # numpy dtype consisting of a list of numpy dtypes.  Apparently
-    # testing for equality against it causes creation of a numpy array
-    # of the given dtype, which numpy doesn't understand.  That's the
-    # only other strange case I see right now.  It requires me to
-    # protect both the numpy and the non-numpy equality tests with
-    # try..except.
-    #
-    # distutils.version.LooseVersion fails unless both objects have a
-    # __version__ attribute.  So if they're not both instances of
-    # distutils.version.LooseVersion, return False
-    if distutils and (
-        (
-            isinstance(needle, distutils.version.LooseVersion)
-            and not isinstance(obj, distutils.version.LooseVersion)
-        )
-        or (
-            not isinstance(needle, distutils.version.LooseVersion)
-            and isinstance(obj, distutils.version.LooseVersion)
-        )
-    ):
-        return False
-
-    # Numpy has well-motivated behavior, so just handle it explicitly.
-    # If you test any sequence against any numpy type, you get a
-    # sequence, not a single boolean.
-    if numpy and (
-        type(needle) in list(numpy.typeDict.values())
-        or type(obj) in list(numpy.typeDict.values())
-        or type(needle) is numpy.ndarray
-        or type(obj) is numpy.ndarray
-    ):
-
-        try:
-            result = numpy.all(needle == obj)
-        except Exception:
-            if verbose:
-                print("Exception encountered in test for equality, assuming unequal...")
-            result = False
-        return result
-
-    # if trying to test for equality throws an exception, then they're
-    # evidently not equal.
-    try:
-        result = needle == obj
-    except Exception:
-        if verbose:
-            print("Exception encountered in test for equality, assuming unequal...")
-        result = False
-    return result
+    return prepare_equal(needle)(name, obj)
 
 
 def search_doc(needle, name, obj):
@@ -378,7 +2041,8 @@ def search_name_regexp(needle, name, obj):
 def search_value_regexp(needle, name, obj):
     """Match if regexp needle matches the string representation of obj"""
     if type(obj) not in (tuple, list, dict):
-        return re.search(needle, str(obj))
+        text = render_value(obj)[0]
+        return text is not None and re.search(needle, text)
 
 
 def search_doc_regexp(needle, name, obj):
@@ -393,13 +2057,774 @@ def search_doc_regexp(needle, name, obj):
 
 
 ##############################
-## Apropos interface: commonly use cases with convenient syntax
+## Prepared search functions.  A search function can have a prepare
+## attribute that does the work that only depends on needle once per
+## search, rather than once per object examined.
+def prepare_search(search, needle, renderer=None):
+    """Return a function match(name, obj) that gives the same result as
+    search(needle, name, obj), using search.prepare(needle) if search
+    has it.  Prepare functions with a true renders attribute are also
+    given renderer, the ValueRenderer for the search, if any.
 
+    """
+    prepare = getattr(search, "prepare", None)
+    if prepare is None:
+        return partial(search, needle)
+    if renderer is not None and getattr(prepare, "renders", False):
+        return prepare(needle, renderer)
+    return prepare(needle)
+
+
+def render_value(obj, limit=None):
+    """Return (text, how): the string of obj that the value searches
+    look at, and None if that's all of str(obj), 'truncated' if it's
+    only the first limit characters, or 'skipped' if text is None
+    because making the string would take too long.  limit is
+    apropos_value_limit by default.
+
+    Strings and bytes are cut before they're turned into strings, and
+    objects of the types in apropos_value_skipped_types with more than
+    limit elements are skipped.  Other objects are turned into strings
+    as usual and then cut.
 
-def apropos_name(needle, haystack=None, **kw):
-    """Recursively search for attributes with where needle is a substring
-    of the name.  See apropos() for addtional keyword arguments.
-    Typical usage is apropos_name('string', module).
+    """
+    if limit is None:
+        limit = apropos_value_limit
+    cls = type(obj)
+    if cls is str:
+        if len(obj) > limit:
+            return obj[:limit], "truncated"
+        return obj, None
+    if cls is bytes or cls is bytearray:
+        if len(obj) > limit:
+            return str(obj[:limit]), "truncated"
+        return str(obj), None
+    if cls in apropos_value_skipped_types and len(obj) > limit:
+        return None, "skipped"
+    text = str(obj)
+    if len(text) > limit:
+        return text[:limit], "truncated"
+    return text, None
+
+
+class ValueRenderer(object):
+    """render_value() for one search.  Strings are kept by the id of
+    their object, so that an object found more than once is only turned
+    into a string once.  report(how), if given, is called when an
+    object's string is truncated or skipped, the first time only.
+
+    """
+
+    def __init__(self, limit=None, report=None):
+        self.limit = apropos_value_limit if limit is None else limit
+        self.report = report
+        # Map id to (object, text, how), keeping the object so that its
+        # id isn't reused during the search.
+        self.cache = {}
+
+    def render(self, obj):
+        """Return the string of obj that the value searches look at, or
+        None if it's skipped.
+
+        """
+        if type(obj) is str and len(obj) <= self.limit:
+            return obj
+        entry = self.cache.get(id(obj))
+        if entry is None or entry[0] is not obj:
+            entry = (obj,) + render_value(obj, self.limit)
+            self.cache[id(obj)] = entry
+            if entry[2] is not None and self.report is not None:
+                self.report(entry[2])
+        return entry[1]
+
+
+def prepare_value(needle, renderer=None):
+    """Prepare search_value()"""
+    render = (renderer or ValueRenderer()).render
+
+    def match_value(name, obj):
+        if type(obj) not in (tuple, list, dict):
+            text = render(obj)
+            return text is not None and needle in text
+
+    return match_value
+
+
+prepare_value.renders = True
+search_value.prepare = prepare_value
+
+
+def prepare_equal(needle):
+    """Prepare search_equal()"""
+    # This was more annoying than I thought, as we're walking through
+    # all objects in memory and some of them have poorly written
+    # __cmp__ functions that throw exceptions instead of returning
+    # False
+    #
+    # as of March 2013, for my system, the value
+    # matplotlib.finance.stock_dt also causes problems.  This is a
+    # numpy dtype consisting of a list of numpy dtypes.  Apparently
+    # testing for equality against it causes creation of a numpy array
+    # of the given dtype, which numpy doesn't understand.  That's the
+    # only other strange case I see right now.  It requires me to
+    # protect both the numpy and the non-numpy equality tests with
+    # try..except.
+    #
+    # distutils.version.LooseVersion fails unless both objects have a
+    # __version__ attribute.  So if they're not both instances of
+    # distutils.version.LooseVersion, return False.  If distutils.version
+    # hasn't been imported there are no instances to worry about.
+    loose_version = getattr(sys.modules.get("distutils.version"), "LooseVersion", None)
+    needle_loose = loose_version is not None and isinstance(needle, loose_version)
+    # Numpy has well-motivated behavior, so just handle it explicitly.
+    # If you test any sequence against any numpy type, you get a
+    # sequence, not a single boolean.  A numpy needle tries to make an
+    # array of whatever it's compared with, which can take forever
+    # (numpy.r_ never stops yielding elements), so it's only compared
+    # with search_array_like_types.
+    needle_numpy = isinstance(needle, search_numpy_types)
+
+    def match(name, obj):
+        if loose_version is not None and needle_loose != isinstance(obj, loose_version):
+            return False
+        if needle_numpy and not isinstance(obj, search_array_like_types):
+            return False
+        # if trying to test for equality throws an exception, or gives
+        # something that isn't true or false (numpy.ma.masked gives a
+        # masked array), then they're evidently not equal.
+        try:
+            result = needle == obj
+            if needle_numpy or isinstance(obj, search_numpy_types):
+                result = numpy.all(result)
+            return bool(result)
+        except Exception:
+            if verbose:
+                print("Exception encountered in test for equality, assuming unequal...")
+            return False
+
+    return match
+
+
+search_equal.prepare = prepare_equal
+
+# Types that search_equal() compares with numpy.all(), and the only
+# types that a needle of those types is compared with.
+if numpy:
+    search_numpy_types = (numpy.ndarray, numpy.generic)
+else:
+    search_numpy_types = ()
+search_array_like_types = search_numpy_types + (list, tuple, numbers.Number)
+
+
+def prepare_name_regexp(needle):
+    """Prepare search_name_regexp()"""
+    match = regexp_matcher(needle)
+    return lambda name, obj: name and match(name)
+
+
+search_name_regexp.prepare = prepare_name_regexp
+
+
+def prepare_value_regexp(needle, renderer=None):
+    """Prepare search_value_regexp()"""
+    match = regexp_matcher(needle)
+    render = (renderer or ValueRenderer()).render
+
+    def match_value(name, obj):
+        if type(obj) not in (tuple, list, dict):
+            text = render(obj)
+            return text is not None and match(text)
+
+    return match_value
+
+
+prepare_value_regexp.renders = True
+search_value_regexp.prepare = prepare_value_regexp
+
+
+def prepare_doc_regexp(needle):
+    """Prepare search_doc_regexp()"""
+    match = regexp_matcher(needle)
+    return lambda name, obj: (
+        hasattr(obj, "__doc__") and isstring(obj.__doc__) and match(obj.__doc__)
+    )
+
+
+search_doc_regexp.prepare = prepare_doc_regexp
+
+
+def regexp_matcher(needle):
+    """Return a function of a string that is true if the regexp needle
+    matches it.  needle is compiled once, and strings that don't contain
+    the plain text it needs (see regexp_literal()) are turned down
+    without running the regexp at all.
+
+    """
+    regexp = re.compile(needle)
+    search = regexp.search
+    literal = regexp_literal(regexp)
+    if not literal:
+        return search
+    return lambda text: literal in text and search(text)
+
+
+def regexp_literal(regexp):
+    """Return text that every string matched by the compiled regexp
+    contains: the longest run of plain characters at the top level of
+    the pattern.  Return '' if there's none, or if the regexp ignores
+    case.
+
+    >>> regexp_literal(re.compile('^get_(item|attr)s?$'))
+    'get_'
+
+    """
+    if regexp.flags & re.IGNORECASE or not isinstance(regexp.pattern, str):
+        return ""
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception:
+        return ""
+    longest = run = ""
+    for op, arg in parsed:
+        if op is sre_parse.LITERAL:
+            run += chr(arg)
+            if len(run) > len(longest):
+                longest = run
+        else:
+            run = ""
+    return longest
+
+
+def prepare_many(search, needles, renderer=None):
+    """Return a function match(name, obj) that gives the list of the
+    indices of the needles for which search(needle, name, obj) is true,
+    using search.prepare_many(needles) if search has it.  renderer is
+    as for prepare_search().
+
+    """
+    prepare = getattr(search, "prepare_many", None)
+    if prepare is None:
+        return prepare_each(search, needles, renderer)
+    if renderer is not None and getattr(prepare, "renders", False):
+        return prepare(needles, renderer)
+    return prepare(needles)
+
+
+def prepare_each(search, needles, renderer=None):
+    """prepare_many() for a search function that has to be tried with
+    each needle in turn.
+
+    """
+    matchers = [prepare_search(search, needle, renderer) for needle in needles]
+    return lambda name, obj: [i for i, match in enumerate(matchers) if match(name, obj)]
+
+
+def prepare_many_name(needles):
+    """Prepare search_name() for several needles"""
+    if not all(isstring(needle) for needle in needles):
+        return prepare_each(search_name, needles)
+    match = substrings_matcher(needles)
+    return lambda name, obj: match(name) if name else []
+
+
+search_name.prepare_many = prepare_many_name
+
+
+def prepare_many_value(needles, renderer=None):
+    """Prepare search_value() for several needles"""
+    if not all(isstring(needle) for needle in needles):
+        return prepare_each(search_value, needles, renderer)
+    match = substrings_matcher(needles)
+    render = (renderer or ValueRenderer()).render
+
+    def match_value(name, obj):
+        if type(obj) not in (tuple, list, dict):
+            text = render(obj)
+            if text is not None:
+                return match(text)
+        return []
+
+    return match_value
+
+
+prepare_many_value.renders = True
+search_value.prepare_many = prepare_many_value
+
+
+def prepare_many_doc(needles):
+    """Prepare search_doc() for several needles"""
+    if not all(isstring(needle) for needle in needles):
+        return prepare_each(search_doc, needles)
+    match = substrings_matcher(needles)
+    return lambda name, obj: (
+        match(obj.__doc__)
+        if hasattr(obj, "__doc__") and isstring(obj.__doc__) else []
+    )
+
+
+search_doc.prepare_many = prepare_many_doc
+
+
+def prepare_many_equal(needles):
+    """Prepare search_equal() for several needles"""
+    # Needles that can be hashed are found by looking obj up in a dict
+    # of them, and then checked with search_equal() as usual.  The
+    # others, and numpy types that are equal to sequences, are checked
+    # one by one.
+    matchers = [prepare_equal(needle) for needle in needles]
+    table = {}
+    others = []
+    for i, needle in enumerate(needles):
+        try:
+            if isinstance(needle, search_numpy_types):
+                raise TypeError
+            table.setdefault(needle, []).append(i)
+        except TypeError:
+            others.append(i)
+    hashed = sorted(i for bucket in table.values() for i in bucket)
+    everything = range(len(needles))
+
+    def match(name, obj):
+        if isinstance(obj, search_numpy_types):
+            candidates = everything
+        else:
+            try:
+                candidates = table.get(obj, [])
+            except Exception:
+                candidates = hashed
+            if others:
+                candidates = candidates + others
+        return [i for i in candidates if matchers[i](name, obj)]
+
+    return match
+
+
+search_equal.prepare_many = prepare_many_equal
+
+
+def prepare_many_name_regexp(needles):
+    """Prepare search_name_regexp() for several needles"""
+    match = regexps_matcher(needles)
+    return lambda name, obj: match(name) if name else []
+
+
+search_name_regexp.prepare_many = prepare_many_name_regexp
+
+
+def prepare_many_value_regexp(needles, renderer=None):
+    """Prepare search_value_regexp() for several needles"""
+    match = regexps_matcher(needles)
+    render = (renderer or ValueRenderer()).render
+
+    def match_value(name, obj):
+        if type(obj) not in (tuple, list, dict):
+            text = render(obj)
+            if text is not None:
+                return match(text)
+        return []
+
+    return match_value
+
+
+prepare_many_value_regexp.renders = True
+search_value_regexp.prepare_many = prepare_many_value_regexp
+
+
+def prepare_many_doc_regexp(needles):
+    """Prepare search_doc_regexp() for several needles"""
+    match = regexps_matcher(needles)
+    return lambda name, obj: (
+        match(obj.__doc__)
+        if hasattr(obj, "__doc__") and isstring(obj.__doc__) else []
+    )
+
+
+search_doc_regexp.prepare_many = prepare_many_doc_regexp
+
+
+def substrings_matcher(needles):
+    """Return a function of a string that gives the indices of the
+    needles that are substrings of it.  A regexp of all of the needles
+    turns down strings that contain none of them in one pass.  In the
+    others, each different needle is looked for with the in operator.
+
+    """
+    empty = [i for i, needle in enumerate(needles) if not needle]
+    indices = {}
+    for i, needle in enumerate(needles):
+        if needle:
+            indices.setdefault(needle, []).append(i)
+    if not indices:
+        return lambda text: list(empty)
+    # Longest first, so that a needle that contains another is tried
+    # before it.  Any match will do, though.
+    alternatives = sorted(indices, key=len, reverse=True)
+    any_needle = re.compile("|".join(re.escape(needle) for needle in alternatives)).search
+    candidates = list(indices.items())
+
+    def match(text):
+        if not any_needle(text):
+            return list(empty)
+        found = list(empty)
+        for needle, where in candidates:
+            if needle in text:
+                found.extend(where)
+        return sorted(found)
+
+    return match
+
+
+def regexps_matcher(needles):
+    """Return a function of a string that gives the indices of the
+    regexps in needles that match it.  Where the regexps can be joined
+    into one, it turns down strings that none of them match in one
+    pass.
+
+    """
+    matchers = [regexp_matcher(needle) for needle in needles]
+    regexps = [re.compile(needle) for needle in needles]
+    any_regexp = None
+    # Groups would be numbered differently in the joined regexp, and
+    # flags can't be given in the middle of one.
+    if all(isinstance(regexp.pattern, str) and regexp.groups == 0
+           and regexp.flags == re.UNICODE for regexp in regexps):
+        try:
+            any_regexp = re.compile(
+                "|".join("(?:%s)" % regexp.pattern for regexp in regexps)).search
+        except re.error:
+            pass
+
+    def match(text):
+        if any_regexp is not None and not any_regexp(text):
+            return []
+        return [i for i, match in enumerate(matchers) if match(text)]
+
+    return match
+
+
+##############################
+## Queries: conditions on objects that combine with &, | and ~.
+class Query(object):
+    """A condition that apropos_query() checks for each object.  cost
+    estimates how long checking it takes, relative to comparing a name,
+    so that combinations can check the cheapest conditions first.
+
+    """
+
+    cost = 1
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def prepare(self, renderer=None):
+        """Return a function match(name, obj) that's true if obj
+        matches.  renderer is the ValueRenderer for the search, if any.
+
+        """
+        raise NotImplementedError
+
+    def prepare_descend(self):
+        """Return None if any container might hold matching objects,
+        otherwise a function descend(obj) that's true for the containers
+        worth searching inside.
+
+        """
+        return None
+
+
+class Search(Query):
+    """Query matching the objects for which search(needle, name, obj) is
+    true.
+
+    """
+
+    def __init__(self, search, needle, cost=1):
+        self.search = search
+        self.needle = needle
+        self.cost = cost
+
+    def __repr__(self):
+        return "Search(%s, %r)" % (getattr(self.search, "__name__", self.search), self.needle)
+
+    def prepare(self, renderer=None):
+        return prepare_search(self.search, self.needle, renderer)
+
+
+class Text(Search):
+    """Query matching objects where some text about them contains needle,
+    or matches it if regexp is true.  Subclasses give the pair of search
+    functions and their costs.
+
+    """
+
+    searches = (search_name, search_name_regexp)
+    costs = (1, 2)
+
+    def __init__(self, needle, regexp=False):
+        regexp = bool(regexp)
+        Search.__init__(self, self.searches[regexp], needle, self.costs[regexp])
+        self.regexp = regexp
+
+    def __repr__(self):
+        return "%s(%r%s)" % (type(self).__name__, self.needle,
+                             ", regexp=True" if self.regexp else "")
+
+
+class Name(Text):
+    """Query matching objects whose name contains needle, or matches it
+    if regexp is true.
+
+    """
+
+
+class Doc(Text):
+    """Query matching objects whose docstring contains needle, or
+    matches it if regexp is true.
+
+    """
+
+    searches = (search_doc, search_doc_regexp)
+    costs = (5, 6)
+
+
+class Value(Text):
+    """Query matching objects whose string representation contains
+    needle, or matches it if regexp is true.  This makes a string out of
+    every object it checks, so it's the most expensive query.
+
+    """
+
+    searches = (search_value, search_value_regexp)
+    costs = (20, 21)
+
+
+class Equal(Search):
+    """Query matching objects equal to needle, as search_equal()"""
+
+    def __init__(self, needle):
+        Search.__init__(self, search_equal, needle, 3)
+
+    def __repr__(self):
+        return "Equal(%r)" % (self.needle,)
+
+
+class Type(Query):
+    """Query matching instances of any of types"""
+
+    cost = 0.5
+
+    def __init__(self, *types):
+        self.types = types
+
+    def __repr__(self):
+        return "Type(%s)" % ", ".join(cls.__name__ for cls in self.types)
+
+    def prepare(self, renderer=None):
+        types = self.types
+        return lambda name, obj: isinstance(obj, types)
+
+
+class Within(Type):
+    """Query that only searches inside containers that are instances of
+    any of types, such as Within(dict, types.ModuleType).  It matches
+    every object, so it's meant to be combined with others using &.
+
+    """
+
+    cost = 0
+
+    def __repr__(self):
+        return "Within(%s)" % ", ".join(cls.__name__ for cls in self.types)
+
+    def prepare(self, renderer=None):
+        return lambda name, obj: True
+
+    def prepare_descend(self):
+        types = self.types
+        return lambda obj: isinstance(obj, types)
+
+
+class And(Query):
+    """Query matching objects that match all of queries"""
+
+    def __init__(self, *queries):
+        self.queries = []
+        for query in queries:
+            if type(query) is type(self):
+                self.queries.extend(query.queries)
+            else:
+                self.queries.append(query)
+        self.cost = sum(query.cost for query in self.queries)
+
+    def __repr__(self):
+        return "(%s)" % (" %s " % self.operator).join(map(repr, self.queries))
+
+    operator = "&"
+
+    def prepare(self, renderer=None):
+        matchers = [query.prepare(renderer)
+                    for query in sorted(self.queries, key=lambda query: query.cost)]
+
+        def match(name, obj):
+            for matcher in matchers:
+                if not matcher(name, obj):
+                    return False
+            return True
+
+        return match
+
+    def prepare_descend(self):
+        # Only containers that every query would search inside.
+        descenders = [query.prepare_descend() for query in self.queries]
+        descenders = [descend for descend in descenders if descend is not None]
+        if not descenders:
+            return None
+        if len(descenders) == 1:
+            return descenders[0]
+        return lambda obj: all(descend(obj) for descend in descenders)
+
+
+class Or(And):
+    """Query matching objects that match any of queries"""
+
+    operator = "|"
+
+    def prepare(self, renderer=None):
+        matchers = [query.prepare(renderer)
+                    for query in sorted(self.queries, key=lambda query: query.cost)]
+
+        def match(name, obj):
+            for matcher in matchers:
+                if matcher(name, obj):
+                    return True
+            return False
+
+        return match
+
+    def prepare_descend(self):
+        # Containers that any of the queries would search inside.
+        descenders = [query.prepare_descend() for query in self.queries]
+        if any(descend is None for descend in descenders):
+            return None
+        return lambda obj: any(descend(obj) for descend in descenders)
+
+
+class Not(Query):
+    """Query matching objects that don't match query"""
+
+    def __init__(self, query):
+        self.query = query
+        self.cost = query.cost
+
+    def __repr__(self):
+        return "~%r" % (self.query,)
+
+    def prepare(self, renderer=None):
+        match = self.query.prepare(renderer)
+        return lambda name, obj: not match(name, obj)
+
+
+def search_query(needle, name, obj):
+    """Match if the Query needle matches obj"""
+    return needle.prepare()(name, obj)
+
+
+def prepare_query(needle, renderer=None):
+    """Prepare search_query()"""
+    return needle.prepare(renderer)
+
+
+prepare_query.renders = True
+
+
+def prepare_descend_query(needle):
+    """The containers that search_query() searches inside"""
+    return needle.prepare_descend()
+
+
+search_query.prepare = prepare_query
+search_query.prepare_descend = prepare_descend_query
+
+
+##############################
+## Searching inside numpy arrays.
+class Near(object):
+    """apropos_array() needle matching numbers within tolerance of
+    value.
+
+    """
+
+    def __init__(self, value, tolerance):
+        self.value = value
+        self.tolerance = tolerance
+
+    def __repr__(self):
+        return "Near(%r, %r)" % (self.value, self.tolerance)
+
+
+def array_matches(needle, obj):
+    """Return the indices of the elements of obj that match needle, as
+    numpy.argwhere() gives them, or None if obj isn't a numpy array or
+    none of its elements match.  See apropos_array() for the needles.
+
+    """
+    if not (numpy and isinstance(obj, numpy.ndarray)):
+        return None
+    kind = obj.dtype.kind
+    try:
+        if isinstance(needle, Near):
+            if kind not in "biufc":
+                return None
+            mask = numpy.isclose(obj, needle.value, rtol=0, atol=needle.tolerance)
+        elif isinstance(needle, str):
+            if kind != "U":
+                return None
+            mask = numpy.char.find(obj, needle) >= 0
+        elif isinstance(needle, bytes):
+            if kind != "S":
+                return None
+            mask = numpy.char.find(obj, needle) >= 0
+        elif callable(needle):
+            mask = needle(obj)
+        elif kind in "USV":
+            return None
+        elif needle != needle:
+            # NaN isn't equal to itself
+            if kind not in "fc":
+                return None
+            mask = numpy.isnan(obj)
+        else:
+            mask = obj == needle
+    except Exception:
+        return None
+    if not (isinstance(mask, numpy.ndarray) and mask.dtype == bool
+            and mask.shape == obj.shape and mask.any()):
+        return None
+    return numpy.argwhere(mask)
+
+
+def search_array(needle, name, obj):
+    """Match if obj is a numpy array with elements matching needle (see
+    apropos_array())
+
+    """
+    return array_matches(needle, obj) is not None
+
+
+##############################
+## Apropos interface: commonly use cases with convenient syntax
+
+
+def apropos_name(needle, haystack=None, **kw):
+    """Recursively search for attributes with where needle is a substring
+    of the name.  See apropos() for addtional keyword arguments.
+    Typical usage is apropos_name('string', module).
 
     Return a list of strings showing the path to reach the matching
     object
@@ -474,56 +2899,692 @@ def apropos_doc_regexp(needle, haystack=None, **kw):
 
 ##################################################
 ## Apropos implementation guts.
-def _apropos(needle, haystack, haystack_name, search, max_depth=None, **kw):
-    """Recursively search through haystack looking for needle.
+class AproposResult(list):
+    """List of apropos matches that also records how the search went.
+
+    stopped is None if the search ran to completion, otherwise the
+    reason it stopped early: the name of the limit that stopped it
+    ('max_nodes', 'max_results' or 'time_limit') or 'interrupted'.
+    nodes is the number of objects examined, depth the depth of the
+    last object searched, pending the number of objects still waiting
+    to be searched and elapsed the time taken in seconds.  truncated
+    lists the access strings of the containers that weren't searched
+    completely because of max_children.  values_truncated and
+    values_skipped list the objects whose strings value searches only
+    looked at part of, or not at all (see render_value()).
 
-    haystack can be any python object.  Typically it's a module.  If
-    it's not given, it's the dict returned by globals() (ie, watch
-    out, it's going to take a while).
+    """
 
-    Matches determined by search.  search(needle, name, obj) returns
-    true if the object should be considered a match.  By default,
-    search matches if needle is a substring of the name of the object.
+    stopped = None
+    nodes = 0
+    depth = 0
+    pending = 0
+    elapsed = 0.0
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.truncated = []
+        self.values_truncated = []
+        self.values_skipped = []
+
+    def status_from(self, other):
+        """Say the search went as it did for other, another
+        AproposResult.
+
+        """
+        for attribute in ("stopped", "nodes", "depth", "pending", "elapsed",
+                          "truncated", "values_truncated", "values_skipped"):
+            setattr(self, attribute, getattr(other, attribute))
+
+    def summary(self):
+        """Return a one line description of how far the search got"""
+        if self.stopped is None:
+            how = "Search complete"
+        else:
+            how = "Search stopped by %s" % self.stopped
+        summary = "%s: %d matches, %d objects examined to depth %d, %d pending, %.2fs" % (
+            how,
+            len(self),
+            self.nodes,
+            self.depth,
+            self.pending,
+            self.elapsed,
+        )
+        if self.truncated:
+            summary += ", %d containers truncated" % len(self.truncated)
+        if self.values_truncated or self.values_skipped:
+            summary += ", %d values truncated, %d skipped" % (
+                len(self.values_truncated), len(self.values_skipped))
+        return summary
 
-    name is the name of the top level object.  It's first bit of the
-    'accessor' strings that are returned.  If not specified, defaults
-    to 'arg'.
 
-    Return a list of strings showing the path to reach the matching
-    object.
+class AproposSearch(object):
+    """Recursively search through haystack looking for needle, in a
+    way that can be stopped and picked up again later.  Arguments are
+    the same as for apropos().
+
+    The search keeps everything it needs to continue: the queue of
+    objects still to be searched, the objects already searched, and
+    the matches found so far in result, an AproposResult.  run()
+    searches until done, until a limit is hit, or until interrupted
+    with Ctrl-C, and returns result.  resume() continues from where the
+    last run stopped without examining anything twice.
+
+    >>> s = AproposSearch('cmap', matplotlib, time_limit=5)
+    >>> s.run()
+    >>> s.resume()
+
+    Iterating over the search gives the new matches as they're found.
 
     """
-    # To get shortest path to access whatever we find, use breadth first search.
-    search_types = apropos_dict_types + apropos_list_types + apropos_instance_types
-    print_warning = True
-    searched_ids = []
-    found = []
-    # queue is a list of tuples, where each tuple is:
-    # (object_to_search, name_of_object, full_path_to_object, depth_of_object)
-    queue = [(haystack, haystack_name, haystack_name, 0)]
-    while queue:
-        obj, obj_name, full_name, depth = queue.pop(0)
 
-        ## Examine present object
+    def __init__(
+        self,
+        needle,
+        haystack=None,
+        name=None,
+        search=None,
+        max_depth=None,
+        max_nodes=None,
+        max_results=None,
+        time_limit=None,
+        instances=False,
+        static=True,
+        value_limit=None,
+        **kw
+    ):
+        if haystack is None:
+            # TODO Think this is wrong.  Want call to globals to be from user's
+            # namespace, not the module space here.  Is there a way to
+            # climb up the call stack and steal it from them?  Probably...
+            haystack = globals()
+            name = ""
+        elif name is None:
+            if hasattr(haystack, "__name__"):
+                name = haystack.__name__
+            else:
+                name = "arg"
+
+        if search is None:
+            search = search_query if isinstance(needle, Query) else search_name
+
+        self.needle = needle
+        self.haystack = haystack
+        self.name = name
+        self.search = search
+        self.result = AproposResult()
+        # The path of the object being matched, for report_value()
+        self.path = None
+        self.renderer = ValueRenderer(value_limit, self.report_value)
+        self.match = self.prepare()
+        self.descend = self.prepare_descend()
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_results = max_results
+        self.time_limit = time_limit
+        self.instances = instances
+        self.static = static
+        # Arguments for the introspectors.  Random samples of big
+        # containers have to be the same every time a container is
+        # looked at so that the search can be resumed.
+        if kw.get("sample") == "random" and kw.get("seed") is None:
+            kw["seed"] = random.randrange(2**32)
+        self.kw = kw
+
+        # queue holds tuples of
+        # (object_to_search, path_to_object, depth_of_object)
+        self.queue = deque()
+        # Map id to object, rather than keeping a set of ids, so that
+        # temporary containers (from __apropos__, say) stay alive and
+        # their ids can't be reused by something else during the search.
+        self.searched = {}
+        # The object whose children were being searched when the last
+        # run stopped, as (object, path, depth, number_of_children_done)
+        self.current = None
+        self.started = False
+        self.print_warning = True
+
+    def done(self):
+        """Return True if there's nothing left to search"""
+        return self.started and not self.queue and self.current is None
+
+    def run(self, report=None):
+        """Search until done, a limit is hit or Ctrl-C is pressed.  Call
+        report(match) for each match as it's found, if given.  Return
+        the AproposResult with all of the matches found so far.
+
+        """
+        try:
+            for match in self:
+                if report is not None:
+                    report(match)
+        except KeyboardInterrupt:
+            self.result.stopped = "interrupted"
+        return self.result
+
+    def resume(self, report=None, **limits):
+        """Continue the search from where it stopped.  The limits
+        max_nodes, max_results and time_limit apply to each run, and
+        can be changed by passing them as keyword arguments.  Return
+        the AproposResult with all of the matches found so far.
+
+        """
+        for limit, value in limits.items():
+            if limit not in ("max_nodes", "max_results", "time_limit"):
+                raise TypeError("resume() got an unexpected keyword argument " + limit)
+            setattr(self, limit, value)
+        return self.run(report)
+
+    def prepare(self):
+        """Return the function match(name, obj) that tells whether obj
+        matches.
+
+        """
+        return prepare_search(self.search, self.needle, self.renderer)
+
+    def prepare_descend(self):
+        """Return None, or a function descend(obj) that's true for the
+        containers to search inside.
+
+        """
+        prepare = getattr(self.search, "prepare_descend", None)
+        if prepare is None:
+            return None
+        return prepare(self.needle)
+
+    def report_value(self, how):
+        """Note that the string of the object being matched was how,
+        'truncated' or 'skipped', by the value search.
+
+        """
+        if how == "truncated":
+            self.result.values_truncated.append(access_string(self.path))
+        else:
+            self.result.values_skipped.append(access_string(self.path))
+
+    def matches(self, obj_name, obj, path):
+        """Return true if obj matches"""
+        self.path = path
         try:
-            if search(needle, obj_name, obj):
-                found.append(full_name)
+            return self.match(obj_name, obj)
         except (UnicodeDecodeError, UnicodeEncodeError):
-            if print_warning:
-                print("Unicode string problems at", full_name)
-                print_warning = False
+            if self.print_warning:
+                print("Unicode string problems at", access_string(path))
+                self.print_warning = False
+        return False
+
+    def __iter__(self):
+        """Continue the search, yielding strings showing the path to reach
+        the matching objects, in breadth first order.  Matches are also
+        added to result.
+
+        """
+        # To get shortest path to access whatever we find, use breadth
+        # first search.  Every child is tested as soon as its parent is
+        # expanded.  Since the queue is first in, first out, that's
+        # exactly the order in which children would come off the queue,
+        # so the shortest path ordering of the results is preserved
+        # while only objects that can actually be expanded ever go onto
+        # the queue.
+        #
+        # Paths are kept as (parent_path, access, key) tuples, where
+        # access is a format string like '[%s]' that turns key into the
+        # access_string.  The string for a path is only built when an
+        # object matches, since the vast majority of them never do.
+        #
+        # All of the state lives on self, and is brought up to date in
+        # the finally clause, so that the search can pick up where it
+        # left off after a limit, an exception or Ctrl-C, or after the
+        # caller simply stops asking for matches.
+        introspectors = IntrospectorCache(self.instances, self.static)
+        matches = self.matches
+        descend = self.descend
+        result = self.result
+        queue = self.queue
+        searched = self.searched
+        max_depth = self.max_depth
+        max_nodes = self.max_nodes
+        max_results = self.max_results
+        result.stopped = None
+
+        start = time.monotonic()
+        deadline = start + self.time_limit if self.time_limit else None
+        nodes = 0
+        found = 0
+        depth = result.depth
+        current = self.current
+        # Only look at the clock every so often.  check_at is the node
+        # count at which to check the limits on the number of nodes and
+        # time.
+        check_every = 256
+        check_at = min(check_every, max_nodes) if max_nodes else check_every
+        try:
+            if not self.started:
+                nodes += 1
+                path = (None, "%s", self.name)
+                match = matches(self.name, self.haystack, path)
+                if match:
+                    result.append(self.name)
+                if introspectors[type(self.haystack)]:
+                    searched[id(self.haystack)] = self.haystack
+                    queue.append((self.haystack, path, 0))
+                self.started = True
+                if match:
+                    found += 1
+                    yield self.name
+                    if found == max_results:
+                        result.stopped = "max_results"
+                        return
+
+            while current is not None or queue:
+                if current is None:
+                    obj, path, depth = queue.popleft()
+                    if max_depth and depth >= max_depth:
+                        continue
+                    current = [obj, path, depth, 0]
+                else:
+                    obj, path, depth, _ = current
+                kw = self.kw
+                if "seed" in kw:
+                    kw = dict(kw, seed=hash((kw["seed"], id(obj))))
+                function, access = introspectors[type(obj)]
+                children, truncated = function(obj, **kw)
+                if current[3]:
+                    children = islice(children, current[3], None)
+                elif truncated:
+                    result.truncated.append(access_string(path))
+                for child, child_name, key in children:
+                    if nodes >= check_at:
+                        if nodes == max_nodes:
+                            result.stopped = "max_nodes"
+                            return
+                        if deadline and time.monotonic() > deadline:
+                            result.stopped = "time_limit"
+                            return
+                        check_at = nodes + check_every
+                        if max_nodes:
+                            check_at = min(check_at, max_nodes)
+                    nodes += 1
+                    match = matches(child_name, child, (path, access, key))
+                    if match:
+                        match = access_string((path, access, key))
+                        result.append(match)
+                    if (
+                        introspectors[type(child)]
+                        and id(child) not in searched
+                        and (descend is None or descend(child))
+                    ):
+                        searched[id(child)] = child
+                        queue.append((child, (path, access, key), depth + 1))
+                    current[3] += 1
+                    if match:
+                        found += 1
+                        yield match
+                        if found == max_results:
+                            result.stopped = "max_results"
+                            return
+                current = None
+        finally:
+            self.current = current
+            result.nodes += nodes
+            result.depth = depth
+            result.pending = len(queue) + (current is not None)
+            result.elapsed += time.monotonic() - start
+            if self.done():
+                # Nothing is left to resume, so let go of every object
+                # looked at and its string.
+                searched.clear()
+                self.renderer.cache.clear()
+
+
+class AproposManySearch(AproposSearch):
+    """An AproposSearch for several needles at once.  needles is a list
+    of them, and results a list of AproposResult, one for each needle in
+    the same order.  result, and iterating, give the objects that match
+    any needle.
+
+    """
+
+    def __init__(self, needles, haystack=None, name=None, search=None, **kw):
+        needles = list(needles)
+        self.results = [AproposResult() for needle in needles]
+        AproposSearch.__init__(self, needles, haystack, name, search, **kw)
+
+    def prepare(self):
+        """Return the function match(name, obj) that gives the indices of
+        the needles that obj matches.
+
+        """
+        return prepare_many(self.search, self.needle, self.renderer)
+
+    def prepare_descend(self):
+        """Return None: containers worth searching for one needle could
+        hold matches for another.
+
+        """
+        return None
+
+    def matches(self, obj_name, obj, path):
+        """Return the list of the indices of the needles obj matches, and
+        add it to their results.
+
+        """
+        found = AproposSearch.matches(self, obj_name, obj, path)
+        if found:
+            match = access_string(path)
+            for i in found:
+                self.results[i].append(match)
+        return found
+
+
+class AproposArraySearch(AproposSearch):
+    """An AproposSearch for numpy arrays with elements matching needle.
+    indices maps the access string of each matching array to the
+    indices of its matching elements, as numpy.argwhere() gives them.
+
+    """
+
+    def __init__(self, needle, haystack=None, name=None, **kw):
+        self.indices = {}
+        AproposSearch.__init__(self, needle, haystack, name, search_array, **kw)
 
-        ## Queue children
+    def prepare(self):
+        """Return the function match(name, obj) that gives the indices of
+        the matching elements of obj, or None.
+
+        """
+        needle = self.needle
+        return lambda name, obj: array_matches(needle, obj)
+
+    def matches(self, obj_name, obj, path):
+        """Return true if obj is an array with matching elements, and
+        note their indices.
+
+        """
+        indices = AproposSearch.matches(self, obj_name, obj, path)
+        if indices is None or indices is False:
+            return False
+        self.indices[access_string(path)] = indices
+        return True
+
+
+def access_string(path):
+    """Return the access string for a path built by _apropos(), a
+    (parent_path, access, key) tuple.
+
+    """
+    parts = []
+    while path is not None:
+        path, access, key = path
+        parts.append(access % (key,))
+    return "".join(reversed(parts))
+
+
+def register_introspector(cls, function, access):
+    """Tell apropos how to search inside objects of type cls (and its
+    subclasses).
+
+    function(obj, **kw) returns a tuple (children, truncated).
+    children iterates over (element_object, name_string, key) tuples
+    giving the contents of obj, and truncated is the number of them
+    left out because of the max_children keyword argument (see
+    select_children()).  kw are the keyword arguments given to
+    apropos() that it doesn't use itself.  access is a format string
+    that turns a key into the access_string, such as '[%s]' or '.%s'.
+
+    >>> register_introspector(collections.deque, list_children, '[%s]')
+
+    """
+    apropos_introspectors[cls] = (function, access)
+
+
+def find_introspector(cls):
+    """Return the (function, access) pair for searching inside objects
+    of type cls, or None if apropos doesn't descend into them.  The
+    type itself takes precedence, then the __apropos__ function, then
+    the base classes in method resolution order.
+
+    """
+    for klass in cls.__mro__:
+        if klass in apropos_introspectors:
+            return apropos_introspectors[klass]
+        if klass in apropos_dict_types:
+            return dict_children, "[%s]"
+        if klass in apropos_list_types:
+            return list_children, "[%s]"
+        if klass in apropos_instance_types:
+            return instance_children, ".%s"
+        if klass is cls and hasattr(cls, "__apropos__"):
+            return user_children, "%s"
+    return None
+
+
+class IntrospectorCache(dict):
+    """Dict mapping types to the result of find_introspector(), filled in
+    as types are looked up.  One of these lasts for one search, so
+    changes to the lists of types take effect for the next search.
+
+    If instances is true, also search inside instances of user classes
+    (including dataclasses) through their __dict__ and __slots__, and
+    inside namedtuples by field name.  If static is false, use dir() and
+    getattr() for modules and instances instead.
+
+    """
+
+    def __init__(self, instances=False, static=True):
+        dict.__init__(self)
+        self.instances = instances
+        self.static = static
+
+    def __missing__(self, cls):
+        entry = find_introspector(cls)
+        if self.instances:
+            if issubclass(cls, tuple) and hasattr(cls, "_fields"):
+                if entry is None or entry[0] is list_children:
+                    entry = namedtuple_children, ".%s"
+            elif entry is None and is_user_class(cls):
+                entry = partial(instance_children, slots=slot_descriptors(cls)), ".%s"
         if (
-            type(obj) in search_types
-            and (not max_depth or depth < max_depth)
-            and id(obj) not in searched_ids
+            not self.static
+            and entry is not None
+            and getattr(entry[0], "func", entry[0]) is instance_children
         ):
+            entry = dynamic_instance_children, ".%s"
+        self[cls] = entry
+        return entry
+
+
+def is_user_class(cls):
+    """Return True if instances of cls are user objects with attributes
+    of their own, in an instance __dict__ or __slots__.
+
+    """
+    if issubclass(cls, type) or cls.__module__ == "builtins":
+        return False
+    return any("__dict__" in vars(klass) for klass in cls.__mro__) or bool(
+        slot_descriptors(cls)
+    )
+
+
+def slot_descriptors(cls):
+    """Return a list of (name, descriptor) pairs for the __slots__ of cls
+    and its base classes.  Names are mangled the same way Python does it.
+
+    """
+    return [
+        (name, value)
+        for klass in cls.__mro__
+        if "__slots__" in vars(klass)
+        for name, value in vars(klass).items()
+        if type(value) is types.MemberDescriptorType
+    ]
+
+
+def select_children(n, max_children=None, sample="head", seed=None):
+    """Decide which of the n children of a container to search, given
+    the max_children, sample and seed keyword arguments to apropos().
+    If sample is 'head' take the first max_children, if it's 'random'
+    take a random selection, in order, chosen with random.Random(seed).
+
+    Return (selected, truncated) where selected is None if all of them
+    should be searched, otherwise the sorted indices of the ones that
+    should, and truncated is the number left out.
+
+    """
+    if sample not in ("head", "random"):
+        raise ValueError("sample must be 'head' or 'random', not %r" % (sample,))
+    if not max_children or n <= max_children:
+        return None, 0
+    if sample == "head":
+        return range(max_children), n - max_children
+    selected = sorted(random.Random(seed).sample(range(n), max_children))
+    return selected, n - max_children
+
+
+##############################
+## Functions listing the contents of objects for apropos.  See
+## register_introspector()
+def dict_children(obj, exclude=None, **kw):
+    """Contents of things you access via [string]"""
+    # The contents of a dict are read directly, so that a subclass's
+    # __getitem__ and __iter__ aren't run.
+    if isinstance(obj, dict):
+        items = dict.items(obj)
+        size = len(items)
+    else:
+        items = mapping_items(obj)
+        size = len(obj)
+    selected, truncated = select_children(size, **kw)
+    if selected is not None:
+        if type(selected) is range:
+            items = islice(items, len(selected))
+        else:
+            items = list(items)
+            items = [items[i] for i in selected]
+    # TODO -- completely skip non-string key entries
+    if exclude:
+        return ((v, k, k) for k, v in items
+                if type(k) is str and not k.startswith(exclude)), truncated
+    return ((v, k, k) for k, v in items if type(k) is str), truncated
+
+
+def mapping_items(obj):
+    """Yield the (key, value) pairs of obj, a mapping that isn't a dict.
+    Keys whose value can't be looked up are left out.  Keys that aren't
+    strings, which are dropped anyway, aren't looked up and come with
+    the value None.
+
+    """
+    for key in obj:
+        value = None
+        if type(key) is str:
+            try:
+                value = obj[key]
+            except Exception:
+                continue
+        yield key, value
+
+
+def list_children(obj, exclude=None, **kw):
+    """Contents of things you access via [int]"""
+    try:
+        selected, truncated = select_children(len(obj), **kw)
+    except TypeError:
+        # Not every iterable has a length
+        selected, truncated = None, 0
+    if selected is None:
+        return zip(obj, repeat(None), count()), truncated
+    if type(selected) is range:
+        return zip(islice(obj, len(selected)), repeat(None), count()), truncated
+    return ((obj[i], None, i) for i in selected), truncated
 
-            searched_ids.append(id(obj))
-            for child, child_name, child_access in introspect(obj, **kw):
-                queue.append((child, child_name, full_name + child_access, depth + 1))
-    return found
+
+def instance_children(obj, exclude=None, slots=None, **kw):
+    """Contents of things you access via .
+
+    Attributes are read straight from the instance __dict__ and from
+    the __slots__ given by slot_descriptors(), which is much faster than
+    dir() and getattr() and never runs properties or __getattr__.
+
+    """
+    try:
+        contents = list(vars(obj).items())
+    except TypeError:
+        contents = []
+    if slots is None:
+        slots = slot_descriptors(type(obj))
+    for name, descriptor in slots:
+        try:
+            contents.append((name, descriptor.__get__(obj, type(obj))))
+        except AttributeError:
+            # Empty slot
+            pass
+    selected, truncated = select_children(len(contents), **kw)
+    if selected is not None:
+        contents = [contents[i] for i in selected]
+    # IPython structs allow non-string attributes.  Filter them
+    # out because they cause problems.  That is, you have to
+    # access them via obj[1], not getattr(obj, 1) or
+    # getattr(obj, '1').
+    return (
+        (value, name, name)
+        for name, value in contents
+        if type(name) is str and not (exclude and name.startswith(exclude))
+    ), truncated
+
+
+def dynamic_instance_children(obj, exclude=None, **kw):
+    """Contents of things you access via ., found with dir() and
+    getattr().  This runs properties, __getattr__ and __dir__.
+
+    """
+    names = [
+        name
+        for name in dir(obj)
+        if type(name) is str and not (exclude and name.startswith(exclude))
+    ]
+    selected, truncated = select_children(len(names), **kw)
+    if selected is not None:
+        names = [names[i] for i in selected]
+    return _getattrs(obj, names), truncated
+
+
+def _getattrs(obj, names):
+    """Yield (attribute, name, name) for the attributes of obj that can
+    be fetched.
+
+    """
+    for name in names:
+        try:
+            attr = getattr(obj, name)
+        except Exception:
+            continue
+        yield attr, name, name
+
+
+def namedtuple_children(obj, exclude=None, **kw):
+    """Contents of namedtuples, by field name"""
+    fields = obj._fields
+    if exclude:
+        return (
+            (value, name, name)
+            for value, name in zip(obj, fields)
+            if not name.startswith(exclude)
+        ), 0
+    return zip(obj, fields, fields), 0
+
+
+def user_children(obj, **kw):
+    """Contents of objects with an __apropos__ function, which gives
+    complete access strings.
+
+    """
+    return obj.__apropos__(), 0
+
+
+def null_children(obj, **kw):
+    """Contents of objects apropos doesn't know how to search"""
+    return iter(()), 0
 
 
 def introspect(obj, **kw):
@@ -531,92 +3592,60 @@ def introspect(obj, **kw):
     obj
 
     """
-    if type(obj) in apropos_dict_types:
-        return DictIntrospector(obj, **kw)
-    if type(obj) in apropos_list_types:
-        return ListIntrospector(obj, **kw)
-    if type(obj) in apropos_instance_types:
-        return InstanceIntrospector(obj, **kw)
-
-    # User objects
-    if hasattr(obj, "__apropos__"):
-        return obj.__apropos__(**kw)
+    entry = find_introspector(type(obj))
+    if entry is None:
+        # Stymied
+        print("apropos.py: Warning, don't know how to deal with " + str(obj))
+        return NullIntrospector()
+    function, access = entry
+    introspector = Introspector(obj, **kw)
+    introspector.children, introspector.truncated = function(obj, **kw)
+    introspector.access = access
+    return introspector
 
-    # Stymied
-    print("apropos.py: Warning, don't know how to deal with " + str(obj))
-    return NullIntrospector()
 
-
-# NOTE These introspectors simplify the code, but they seem to take about five
-# times as long, very unfortunately.
+##############################
+## Iterators over the contents of objects.  apropos uses the functions
+## above directly, which is much faster.  These give the
+## (element_object, name_string, access_string) tuples that __apropos__
+## gives.
 class Introspector(object):
     """Object that implements the iterator interface"""
 
+    function = staticmethod(null_children)
+    access = "%s"
+
+    def __init__(self, obj, **kw):
+        self.children, self.truncated = self.function(obj, **kw)
+
     def __iter__(self):
         return self
 
     def __next__(self):
-        pass
+        # return tuple of obj, name, access_name
+        obj, name, key = next(self.children)
+        return obj, name, self.access % (key,)
 
 
 class DictIntrospector(Introspector):
     """Object that can iterate over the contents of a dict"""
 
-    # types that respond to __iter__, obj.[key] to get a value
-    def __init__(self, dict, exclude=None):
-        self.dict = dict
-        self.iter = self.dict.__iter__()
-        self.exclude = exclude
-
-    def __next__(self):
-        # return tuple of obj, name, access_name
-        k = next(self.iter)
-        # TODO -- completely skip non-string key entries
-        while not isstring(k) or (self.exclude and k.startswith(self.exclude)):
-            k = next(self.iter)
-        return self.dict[k], k, "[" + k + "]"
+    function = staticmethod(dict_children)
+    access = "[%s]"
 
 
 class ListIntrospector(Introspector):
     """Object that can iterate over the contents of a list"""
 
-    # types that respond to __iter__
-    def __init__(self, list, exclude=None):
-        self.list = list
-        self.iter = self.list.__iter__()
-        self.i = 0
-
-    def __next__(self):
-        # return tuple of obj, name, access_name
-        self.i += 1
-        return next(self.iter), None, "[" + str(self.i - 1) + "]"
+    function = staticmethod(list_children)
+    access = "[%s]"
 
 
 class InstanceIntrospector(Introspector):
     """Object that can iterate over the contents of a instance"""
 
-    # classes that respond to dir and getattr
-    def __init__(self, inst, exclude=None):
-        self.inst = inst
-        self.iter = dir(self.inst).__iter__()
-        self.exclude = exclude
-
-    def __next__(self):
-        # return tuple of obj, name, access_name
-
-        # IPython structs allow non-string attributes.  Filter them
-        # out because they cause problems.  That is, you have to
-        # access them via obj[1], not getattr(obj, 1) or
-        # getattr(obj, '1').
-        # TODO -- could handle the above w/ use of eval
-        # TODO -- filter out non-string things that appear in dir()
-
-        name = next(self.iter)
-        while type(name) is not bytes or (
-            self.exclude and name.startswith(self.exclude)
-        ):
-            name = next(self.iter)
-        return getattr(self.inst, name), name, "." + name
+    function = staticmethod(instance_children)
+    access = ".%s"
 
 
 class NullIntrospector(Introspector):
@@ -626,10 +3655,7 @@ class NullIntrospector(Introspector):
     """
 
     def __init__(self, **kw):
-        pass
-
-    def __next__(self):
-        raise StopIteration
+        Introspector.__init__(self, None, **kw)
 
 
 ## End of apropos implementation guts.
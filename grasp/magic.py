@@ -15,6 +15,10 @@ dreload_excludes = ["sys", "os.path", "__builtin__", "__main__", "IPython"]
 class AproposMagics(IPython.core.magic.Magics):
     """Magic functions for all of the various apropos possibilities."""
 
+    # The most recent search, kept so %apresume can continue it, or
+    # None once it's done
+    last_search = None
+
     def fetch_or_eval(self, str, nss=tuple()):
         """Try to fetch a name from a namespace.  If that fails, evaluate the
         object.  The order of precedence is: 1) name in the user
@@ -48,10 +52,31 @@ class AproposMagics(IPython.core.magic.Magics):
         #
         # Using mode='list' here makes it easier to be independent of
         # extraneous whitespace.
-        opts, arg_strings = self.parse_options(line, "d:s:", mode="list")
+        opts, arg_strings = self.parse_options(
+            line, "d:s:pn:r:t:f:F:ogl:", mode="list"
+        )
         kw = {}
         if "d" in opts:
             kw["max_depth"] = int(opts["d"])
+        if "n" in opts:
+            kw["max_nodes"] = int(opts["n"])
+        if "r" in opts:
+            kw["max_results"] = int(opts["r"])
+        if "t" in opts:
+            kw["time_limit"] = float(opts["t"])
+        if "f" in opts:
+            kw["max_children"] = int(opts["f"])
+        if "F" in opts:
+            kw["max_children"] = int(opts["F"])
+            kw["sample"] = "random"
+        if "l" in opts:
+            kw["value_limit"] = int(opts["l"])
+        if "o" in opts:
+            kw["instances"] = True
+        if "g" in opts:
+            kw["static"] = False
+        if "p" in opts:
+            kw["incremental"] = True
 
         # It's only legel to provide a search function to apropos(),
         # but parse the option here to keep things centralized.  The
@@ -158,9 +183,88 @@ class AproposMagics(IPython.core.magic.Magics):
 
         return arg, kw
 
+    def run_apropos(self, arg, kw, **search):
+        """Run the search given the output of parse_apropos_args().
+        Return the list of matches or, if the -p switch was given,
+        print each match as soon as it's found.  If one of the limits
+        or Ctrl-C stopped the search, say so.  The search is kept so
+        that %apresume can continue it if it isn't done.
+
+        """
+        incremental = kw.pop("incremental", False)
+        self.last_search = grasp.AproposSearch(*arg, **search, **kw)
+        return self.continue_search(incremental)
+
+    def continue_search(self, incremental, **limits):
+        """Run the last search until it's done or stopped again.  Arguments
+        and return value as for run_apropos().  A search that's done is
+        forgotten, so that the objects it found can be freed.
+
+        """
+        search = self.last_search
+        if incremental:
+            result = search.resume(
+                lambda match: print(self.search_output(search, match)), **limits)
+        else:
+            result = search.resume(**limits)
+        if search.done():
+            self.last_search = None
+        if (
+            result.stopped
+            or result.truncated
+            or result.values_truncated
+            or result.values_skipped
+        ):
+            print(result.summary())
+        if result.stopped:
+            print("Use %apresume to continue the search")
+        if not incremental:
+            return [self.search_output(search, match) for match in result]
+
+    def search_output(self, search, match):
+        """Return what to show of match, a match of search: its access
+        string, with the indices of the matching elements for an array
+        search.
+
+        """
+        if isinstance(search, grasp.AproposArraySearch):
+            return match, search.indices[match]
+        return match
+
+    @IPython.core.magic.line_magic
+    def apresume(self, line):
+        """%apresume [-p] [-n|-r|-t <limit>]
+
+        Continue the last apropos search from where it stopped, whether
+        it was stopped by a limit or by Ctrl-C.  Return the list of all
+        matches found so far, with the indices of the matching elements
+        after %aparray.
+
+        -p : print new matches as they're found rather than returning a
+        list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes more objects, finding max_results more
+        matches or searching for the given number of seconds.  By
+        default the limits of the original search apply again.
+
+        """
+        opts, args = self.parse_options(line, "pn:r:t:", mode="list")
+        if self.last_search is None:
+            print("No apropos search to resume")
+            return
+        limits = {}
+        if "n" in opts:
+            limits["max_nodes"] = int(opts["n"])
+        if "r" in opts:
+            limits["max_results"] = int(opts["r"])
+        if "t" in opts:
+            limits["time_limit"] = float(opts["t"])
+        return self.continue_search("p" in opts, **limits)
+
     @IPython.core.magic.line_magic
     def apropos(self, line):
-        """%apropos [-d <max_depth>] [-s <search_function>] <needle> [haystack]
+        """%apropos [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] [-s <search_function>] <needle> [haystack]
 
         Search for things related to "needle."  Return a list of
         matching names.
@@ -183,13 +287,29 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos(*aa, **kw)
+        return self.run_apropos(aa, kw)
 
     @IPython.core.magic.line_magic
     def apname(self, line):
-        """%apname [-d <max_depth>] <needle> [haystack]
+        """%apname [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] <needle> [haystack]
 
         Search for objects with the string "needle" in their name.
         Return a list of matching names.
@@ -200,13 +320,29 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos_name(*aa, **kw)
+        return self.run_apropos(aa, kw, search=grasp.search_name)
 
     @IPython.core.magic.line_magic
     def apname_regex(self, line):
-        """%apname_regex [-d <max_depth>] <needle> [haystack]
+        """%apname_regex [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] <needle> [haystack]
 
         Search for objects whose name matches regex "needle".  Return
         a list of matching names.
@@ -217,13 +353,29 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos_name_regexp(*aa, **kw)
+        return self.run_apropos(aa, kw, search=grasp.search_name_regexp)
 
     @IPython.core.magic.line_magic
     def apvalue(self, line):
-        """%apvalue [-d <max_depth>] <needle> [haystack]
+        """%apvalue [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] [-l <value_limit>] <needle> [haystack]
 
         Search for objects whose string representation contains
         "needle".  Return a list of matching names.
@@ -234,13 +386,33 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
+        -l <value_limit> : look at only the first value_limit characters
+        of the string of each object (grasp.apropos_value_limit by
+        default).  Objects cut short or skipped are counted in a note.
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos_value(*aa, **kw)
+        return self.run_apropos(aa, kw, search=grasp.search_value)
 
     @IPython.core.magic.line_magic
     def apvalue_regex(self, line):
-        """%apvalue_regex [-d <max_depth>] <needle> [haystack]
+        """%apvalue_regex [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] [-l <value_limit>] <needle> [haystack]
 
         Search for objects whose value matches regex "needle".  Return
         a list of matching names.
@@ -251,13 +423,33 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
+        -l <value_limit> : look at only the first value_limit characters
+        of the string of each object (grasp.apropos_value_limit by
+        default).  Objects cut short or skipped are counted in a note.
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos_value_regexp(*aa, **kw)
+        return self.run_apropos(aa, kw, search=grasp.search_value_regexp)
 
     @IPython.core.magic.line_magic
     def apdoc(self, line):
-        """%apdoc [-d <max_depth>] <needle> [haystack]
+        """%apdoc [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] <needle> [haystack]
 
         Search for objects whose docstring contains "needle".  Return
         a list of matching names.
@@ -268,13 +460,29 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos_doc(*aa, **kw)
+        return self.run_apropos(aa, kw, search=grasp.search_doc)
 
     @IPython.core.magic.line_magic
     def apobj(self, line):
-        """%apobj [-d <max_depth>] [-s search_function] <needle> [haystack]
+        """%apobj [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] [-s search_function] <needle> [haystack]
 
         Search for objects equal to needle.  needle is evaluated.  It
         should be quoted if spaces occur.  Return a list of matching
@@ -289,6 +497,22 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
         -s <search_function> : Give the name of a function that takes
         areguments f(needle, name, obj) where needle is the string
         we're looking for, name is the name of the present object, and
@@ -306,11 +530,118 @@ class AproposMagics(IPython.core.magic.Magics):
         # provide a default for search function
         if "search" not in kw:
             kw["search"] = grasp.search_equal
-        return grasp.apropos(*aa, **kw)
+        return self.run_apropos(aa, kw)
+
+    @IPython.core.magic.line_magic
+    def apquery(self, line):
+        """%apquery [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] [-l <value_limit>] <query> [haystack]
+
+        Search for objects matching query, an expression combining
+        conditions with & (and), | (or) and ~ (not).  It should be quoted
+        with double quotes, so that the quotes inside it are kept.  The
+        conditions are:
+
+        Name(needle), Doc(needle), Value(needle) : the name, docstring or
+        string representation contains needle, or matches it with
+        regexp=True
+
+        Equal(obj) : equal to obj
+
+        Type(types...) : an instance of one of types
+
+        Within(types...) : only search inside containers of these types
+
+        Conditions are checked cheapest first and only as far as needed,
+        so names and types are checked before docstrings and values.
+        The expression is evaluated in the user's namespace.  Return a
+        list of matching names.
+
+        haystack is an optional argument giving the object in which to
+        search.  It can be the name of an object in the user's
+        namespace or a literal object that is passed to eval
+
+        -d <max_depth> : search at most max_depth levels
+
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
+        -l <value_limit> : look at only the first value_limit characters
+        of the string of each object (grasp.apropos_value_limit by
+        default).  Objects cut short or skipped are counted in a note.
+
+        In [1]: %apquery "Name('cmap') & ~Type(str)" matplotlib
+
+        """
+        aa, kw = self.parse_apropos_args(line)
+        namespace = dict(self.shell.user_ns)
+        for query in (grasp.Name, grasp.Doc, grasp.Value, grasp.Equal,
+                      grasp.Type, grasp.Within):
+            namespace[query.__name__] = query
+        aa[0] = eval(aa[0], namespace)
+        return self.run_apropos(aa, kw, search=grasp.search_query)
+
+    @IPython.core.magic.line_magic
+    def aparray(self, line):
+        """%aparray [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] <needle> [haystack]
+
+        Search for numpy arrays with elements matching needle, comparing
+        all of the elements of each array at once.  needle is evaluated,
+        and should be quoted if spaces occur.  It can be a number, nan,
+        Near(value, tolerance), a string or bytes to find in arrays of
+        strings or bytes, or a function such as numpy.isinf that takes an
+        array and returns a boolean array (see grasp.apropos_array()).
+        Return a list of the names of the matching arrays, each with the
+        indices of the matching elements.
+
+        haystack is an optional argument giving the object in which to
+        search.  It can be the name of an object in the user's
+        namespace or a literal object that is passed to eval
+
+        -d <max_depth> : search at most max_depth levels
+
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
+        In [1]: %aparray "lambda a: ~numpy.isfinite(a)" state
+        In [2]: %aparray "Near(1e30, 1e25)" state
+
+        """
+        aa, kw = self.parse_apropos_args(line)
+        namespace = dict(self.shell.user_ns, Near=grasp.Near, nan=float("nan"))
+        aa[0] = eval(aa[0], namespace)
+        incremental = kw.pop("incremental", False)
+        self.last_search = grasp.AproposArraySearch(*aa, **kw)
+        return self.continue_search(incremental)
 
     @IPython.core.magic.line_magic
     def apdoc_regex(self, line):
-        """%apdoc_regex [-d <max_depth>] <needle> [haystack]
+        """%apdoc_regex [-p] [-o] [-g] [-d <max_depth>] [-n|-r|-t <limit>] [-f|-F <max_children>] <needle> [haystack]
 
         Search for objects whose docstring matches regex "needle".
         Return a list of matching names.
@@ -321,9 +652,25 @@ class AproposMagics(IPython.core.magic.Magics):
 
         -d <max_depth> : search at most max_depth levels
 
+        -p : print matches as they're found rather than returning a list
+
+        -n <max_nodes>, -r <max_results>, -t <seconds> : stop after
+        examining max_nodes objects, finding max_results matches or
+        searching for the given number of seconds
+
+        -f <max_children> : search only the first max_children elements
+        of any list, tuple or dict.  -F does the same with a random
+        selection of elements.
+
+        -o : also search inside instances of user classes, dataclasses
+        and namedtuples
+
+        -g : list the contents of modules and instances with dir() and
+        getattr(), which finds more but runs properties and lazy loaders
+
         """
         aa, kw = self.parse_apropos_args(line)
-        return grasp.apropos_doc_regexp(*aa, **kw)
+        return self.run_apropos(aa, kw, search=grasp.search_doc_regexp)
 
 
 @IPython.core.magic.magics_class
@@ -332,7 +679,7 @@ class IntrospectionMagics(IPython.core.magic.Magics):
 
     @IPython.core.magic.line_magic
     def gist(self, line):
-        """%gist object
+        """%gist [-v] [-m] [-s|-g] object
 
         Get the 'gist' (overview) of the given object.  Object can be
         the name of an object in the user's namespace or a literal
@@ -343,6 +690,16 @@ class IntrospectionMagics(IPython.core.magic.Magics):
 
         -v : Verbose output.  Include attributes with a leading underscore.
 
+        -m : Many objects.  Object is a collection; get the gist of each
+        type of object in it once, with the number of objects of that
+        type and the attributes where they differ.
+
+        -s : Static lookup.  Don't run properties, __getattr__ or
+        __dir__; list descriptors by kind instead.  This is the default
+        for modules.
+
+        -g : Look attributes up with getattr(), even for modules.
+
         In [1]: %gist (1,2,3)
         Out[1]: {builtin_function_or_method: [count, index]}
 
@@ -357,16 +714,28 @@ class IntrospectionMagics(IPython.core.magic.Magics):
         # Also recognize this argument, but don't see why people will
         # want it for the magic command, so don't advertise it:
         # -u : 'ugly' output with standard strings (lots of extra quotes)
-        opts, arg = self.parse_options(line, "vu")
+        opts, arg = self.parse_options(line, "vusgm")
         if arg in self.shell.user_ns:
             obj = self.shell.user_ns[arg]
         else:
             obj = eval(arg, self.shell.user_ns)
-        return grasp.gist(obj, verbose="v" in opts, pretty="u" not in opts)
+        static = None
+        if "s" in opts:
+            static = True
+        if "g" in opts:
+            static = False
+        if "m" in opts:
+            function = grasp.gist_many
+        else:
+            function = grasp.gist
+        return function(
+            obj, verbose="v" in opts, pretty="u" not in opts, static=static
+        )
 
     @IPython.core.magic.line_magic
     def rtype(self, line):
-        """%rtype object
+        """%rtype [-r] [-m <max>] [-d <max_depth>] [-s <sample> [-S <seed>]] [-j <n>] object
+        %rtype -f [-n <limit>] [-r] [-m ...] file
 
         Recursive type of object.  Return a list of strings concisely
         describing the object.
@@ -379,8 +748,32 @@ class IntrospectionMagics(IPython.core.magic.Magics):
         if an object is a list of 10 tuples of 3 dicts, rtype will
         tell you as much.
 
+        -r : Records.  Describe lists of dicts, such as JSON records, by
+        merging them into one schema: each key, the types of its values
+        and how many of the dicts have it.
+
         -m <int> : Maximum size of container objects break apart for inspection.
 
+        -d <int> : Maximum depth.  Containers nested deeper than this
+        are described without looking inside them, ending in '…'.
+
+        -s <int> : Sample size.  Describe containers with more elements
+        than this from a sample of them: the first, the last and a
+        random selection of the others.  Much faster for huge
+        containers, but can miss the odd element of a different type.
+
+        -S <int> : Random seed used to choose the sample.
+
+        -j <int> : Describe the elements of big containers (over
+        grasp.recursive_type_parallel_threshold elements) with that many
+        worker processes, or one per CPU if 0.
+
+        -f : File.  Describe the list of records in a JSON Lines (.jsonl)
+        or CSV (.csv, .tsv) file without loading it into memory, or the
+        document in a JSON (.json) file, and print how fast it was read.
+
+        -n <int> : Only look at the first records of the file.
+
         In [1]: %rtype 1
         Out[1]: 'int'
 
@@ -397,10 +790,25 @@ class IntrospectionMagics(IPython.core.magic.Magics):
         Out[5]: ['tuple of 3', 'ndarray of (2,) int64']
 
         """
-        opts, arg = self.parse_options(line, "m:")
+        opts, arg = self.parse_options(line, "rm:d:s:S:fn:j:")
         kw = {}
         if "m" in opts:
             kw["max"] = int(opts["m"])
+        if "d" in opts:
+            kw["max_depth"] = int(opts["d"])
+        if "s" in opts:
+            kw["sample"] = int(opts["s"])
+        if "S" in opts:
+            kw["seed"] = int(opts["S"])
+        if "r" in opts:
+            kw["schema"] = True
+        if "j" in opts:
+            kw["processes"] = int(opts["j"])
+        if "f" in opts:
+            kw.pop("processes", None)
+            if "n" in opts:
+                kw["limit"] = int(opts["n"])
+            return grasp.recursive_type_file(arg, report=print, **kw)
         # if it's not in the user namespace, assume it's a literal object
         if arg in self.shell.user_ns:
             obj = self.shell.user_ns[arg]
@@ -1 +1 @@
-from test_grasp import *
+from .test_grasp import *